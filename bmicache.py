@@ -0,0 +1,361 @@
+"""
+A content-addressed cache of precompiled modules and objects for c++ under MIT license.
+Launched by umake.cmake in front of the compiler, like ccache.
+
+Usage:
+    python bmicache.py [--cache-dir <DIR>] [--max-size <BYTES>] [--reference <BMI> ...] [--] <COMPILER> <ARGS>...
+
+Results are keyed by compiler identity, flags, contents of source files and referenced BMIs,
+and contents of headers reported by the compiler in its dependency file.
+Paths of referenced BMIs are keyed by their contents only, so build trees of the same sources share results.
+Compilers not accepting GCC-style dependency flags, such as MSVC, are launched without caching.
+"""
+
+from __future__ import annotations
+import hashlib
+import json
+import os
+import os.path as path
+import shutil
+import subprocess
+import sys
+from typing import Any, Optional
+
+CACHE_DIR = path.join(path.expanduser("~"), ".cache", "umake", "bmi")
+MAX_SIZE = 5 << 30
+# Ratio of max size to be kept after eviction
+EVICTION_RATIO = 0.9
+# Number of header combinations kept for the same compilation
+MAX_CANDIDATES = 16
+
+MSVC_COMPILERS = {"cl", "cl.exe", "clang-cl", "clang-cl.exe"}
+# Flags followed by an output path
+OUTPUT_FLAGS = {"-o", "-MF"}
+# Flags with an output path attached
+OUTPUT_PREFIXES = ["-fmodule-output="]
+# Flags followed by a referenced BMI or directory of BMIs, optionally after "<module>="
+REFERENCE_FLAGS = {"/reference", "/module:reference", "/ifcSearchDir"}
+# Flags with a referenced BMI or directory of BMIs attached, optionally after "<module>="
+REFERENCE_PREFIXES = ["-fmodule-file=", "-fprebuilt-module-path="]
+
+
+class compilation:
+    def __init__(self, compiler: list[str], references: list[str]) -> None:
+        self.compiler = compiler
+        self.references = references
+        # Indices of output paths in compiler arguments
+        self.outputs: list[tuple[int, str]] = []
+        # Indices of referenced paths in compiler arguments, which differ among build trees
+        self.referenced: list[tuple[int, str]] = []
+        self.depfile: Optional[str] = None
+        args = compiler[1:]
+        i = 0
+        while i < len(args):
+            arg = args[i]
+            if arg in OUTPUT_FLAGS and i + 1 < len(args):
+                self.outputs.append((i + 2, ""))
+                if arg == "-MF":
+                    self.depfile = args[i + 1]
+                i += 2
+                continue
+            if arg in REFERENCE_FLAGS and i + 1 < len(args):
+                self.referenced.append((i + 2, ""))
+                i += 2
+                continue
+            for prefix in REFERENCE_PREFIXES:
+                if arg.startswith(prefix):
+                    self.referenced.append((i + 1, prefix))
+            for prefix in OUTPUT_PREFIXES:
+                if arg.startswith(prefix):
+                    self.outputs.append((i + 1, prefix))
+            if arg.startswith("-o") and len(arg) > 2:
+                self.outputs.append((i + 1, "-o"))
+            i += 1
+
+    def outputPaths(self) -> list[str]:
+        return [self.compiler[i][len(prefix) :] for i, prefix in self.outputs]
+
+    def __repr__(self) -> str:
+        return str(vars(self))
+
+
+def hashFile(relFileToCur: str) -> str:
+    if not path.isfile(relFileToCur):
+        return ""
+    digest = hashlib.sha256()
+    with open(relFileToCur, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def compilerIdentity(compiler: str) -> str:
+    found = shutil.which(compiler)
+    if found is None:
+        return compiler
+    real = path.realpath(found)
+    stat = os.stat(real)
+    return f"{real}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def directKey(unit: compilation) -> str:
+    """
+    Key of a compilation before its headers are known.
+    """
+    digest = hashlib.sha256()
+    digest.update(compilerIdentity(unit.compiler[0]).encode())
+    outputs = {i for i, _prefix in unit.outputs}
+    referenced = dict(unit.referenced)
+    for i, arg in enumerate(unit.compiler[1:], 1):
+        if i in outputs:
+            # Outputs don't affect results
+            digest.update(b"\0<output>")
+        elif i in referenced:
+            # Only module names and contents are kept, so that build trees share results
+            prefix = referenced[i]
+            name, equal, referencedPath = arg[len(prefix) :].rpartition("=")
+            digest.update(f"\0{prefix}{name}{equal}<reference>".encode())
+            digest.update(hashFile(referencedPath).encode())
+        else:
+            digest.update(b"\0" + arg.encode())
+            if path.isfile(arg):
+                digest.update(hashFile(arg).encode())
+    for reference in unit.references:
+        digest.update(b"\0" + hashFile(reference).encode())
+    return digest.hexdigest()
+
+
+def parseDepfile(text: str) -> list[str]:
+    """
+    Prerequisites in a makefile rule written by the compiler.
+    """
+    text = text.replace("\\\r\n", " ").replace("\\\n", " ")
+    depends: list[str] = []
+    for line in text.splitlines():
+        colon = line.find(": ")
+        if colon == -1:
+            if not line.rstrip().endswith(":"):
+                continue
+            colon = len(line.rstrip()) - 1
+        token = ""
+        i = colon + 1
+        while i < len(line):
+            if line[i] == "\\" and i + 1 < len(line) and line[i + 1] in " #":
+                token += line[i + 1]
+                i += 2
+                continue
+            if line[i] == "$" and i + 1 < len(line) and line[i + 1] == "$":
+                token += "$"
+                i += 2
+                continue
+            if line[i].isspace():
+                if token:
+                    depends.append(token)
+                token = ""
+            else:
+                token += line[i]
+            i += 1
+        if token:
+            depends.append(token)
+    return depends
+
+
+def entryKey(key: str, depends: dict[str, str]) -> str:
+    digest = hashlib.sha256(key.encode())
+    for depend, hashed in sorted(depends.items()):
+        digest.update(f"\0{depend}\0{hashed}".encode())
+    return digest.hexdigest()
+
+
+def writeAtomically(relFileToCur: str, data: bytes):
+    relTempToCur = f"{relFileToCur}.{os.getpid()}.tmp"
+    try:
+        with open(relTempToCur, "wb") as file:
+            file.write(data)
+        os.replace(relTempToCur, relFileToCur)
+    finally:
+        if path.exists(relTempToCur):
+            os.remove(relTempToCur)
+
+
+def lookUp(cacheDir: str, key: str, unit: compilation) -> bool:
+    """
+    Restore outputs of a cached compilation whose headers are not changed.
+    """
+    manifestPath = path.join(cacheDir, "manifests", key + ".json")
+    if not path.exists(manifestPath):
+        return False
+    with open(manifestPath) as manifest:
+        candidates: list[dict[str, str]] = json.load(manifest)
+    hashed: dict[str, str] = dict()
+    for depends in candidates:
+        if any(
+            hashed.setdefault(depend, hashFile(depend)) != value
+            for depend, value in depends.items()
+        ):
+            continue
+        entryDir = path.join(cacheDir, "entries", entryKey(key, depends))
+        metaPath = path.join(entryDir, "meta.json")
+        if not path.exists(metaPath):
+            continue
+        with open(metaPath) as meta:
+            info: dict[str, Any] = json.load(meta)
+        outputs = unit.outputPaths()
+        if len(outputs) != info["outputs"]:
+            continue
+        for i, output in enumerate(outputs):
+            if path.dirname(output):
+                os.makedirs(path.dirname(output), exist_ok=True)
+            shutil.copyfile(path.join(entryDir, str(i)), output)
+        # Mark as recently used
+        os.utime(metaPath)
+        sys.stdout.write(info["stdout"])
+        sys.stderr.write(info["stderr"])
+        return True
+    return False
+
+
+def store(
+    cacheDir: str,
+    key: str,
+    unit: compilation,
+    depends: dict[str, str],
+    stdout: str,
+    stderr: str,
+):
+    entriesDir = path.join(cacheDir, "entries")
+    os.makedirs(entriesDir, exist_ok=True)
+    entryDir = path.join(entriesDir, entryKey(key, depends))
+    if not path.exists(entryDir):
+        tempDir = f"{entryDir}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(tempDir)
+            for i, output in enumerate(unit.outputPaths()):
+                shutil.copyfile(output, path.join(tempDir, str(i)))
+            with open(path.join(tempDir, "meta.json"), "w") as meta:
+                json.dump(
+                    dict(outputs=len(unit.outputs), stdout=stdout, stderr=stderr),
+                    meta,
+                )
+            os.rename(tempDir, entryDir)
+        except OSError:
+            # Stored by another process at the same time
+            pass
+        finally:
+            if path.exists(tempDir):
+                shutil.rmtree(tempDir, ignore_errors=True)
+
+    manifestsDir = path.join(cacheDir, "manifests")
+    os.makedirs(manifestsDir, exist_ok=True)
+    manifestPath = path.join(manifestsDir, key + ".json")
+    candidates: list[dict[str, str]] = []
+    if path.exists(manifestPath):
+        try:
+            with open(manifestPath) as manifest:
+                candidates = json.load(manifest)
+        except ValueError:
+            candidates = []
+    candidates = [depends] + [c for c in candidates if c != depends]
+    writeAtomically(
+        manifestPath, json.dumps(candidates[:MAX_CANDIDATES]).encode("utf-8")
+    )
+
+
+def evict(cacheDir: str, maxSize: int):
+    """
+    Remove least recently used entries until the cache fits in max size.
+    """
+    entriesDir = path.join(cacheDir, "entries")
+    if not path.isdir(entriesDir):
+        return
+    entries: list[tuple[float, int, str]] = []
+    total = 0
+    for entry in os.listdir(entriesDir):
+        entryDir = path.join(entriesDir, entry)
+        metaPath = path.join(entryDir, "meta.json")
+        if not path.exists(metaPath):
+            continue
+        size = sum(
+            path.getsize(path.join(entryDir, file)) for file in os.listdir(entryDir)
+        )
+        entries.append((path.getmtime(metaPath), size, entryDir))
+        total += size
+    if total <= maxSize:
+        return
+    for _usedTime, size, entryDir in sorted(entries):
+        shutil.rmtree(entryDir, ignore_errors=True)
+        total -= size
+        if total <= maxSize * EVICTION_RATIO:
+            break
+
+
+def compile(
+    cacheDir: str, maxSize: int, compiler: list[str], references: list[str]
+) -> int:
+    if path.basename(compiler[0]).lower() in MSVC_COMPILERS:
+        return subprocess.call(compiler)
+    unit = compilation(compiler, references)
+    if not unit.outputs:
+        return subprocess.call(compiler)
+
+    key = directKey(unit)
+    if lookUp(cacheDir, key, unit):
+        return 0
+
+    command = list(compiler)
+    depfile = unit.depfile
+    if depfile is None:
+        os.makedirs(cacheDir, exist_ok=True)
+        depfile = path.join(cacheDir, f"{os.getpid()}.d")
+        command += ["-MD", "-MF", depfile]
+    try:
+        result = subprocess.run(command, capture_output=True, text=True)
+        sys.stdout.write(result.stdout)
+        sys.stderr.write(result.stderr)
+        if result.returncode != 0:
+            return result.returncode
+        # Referenced BMIs are already in the key, and their paths differ among build trees
+        referenced = {path.abspath(reference) for reference in references}
+        with open(depfile) as dependencies:
+            depends = {
+                path.abspath(depend): hashFile(depend)
+                for depend in parseDepfile(dependencies.read())
+                if path.abspath(depend) not in referenced
+            }
+    finally:
+        if unit.depfile is None and path.exists(depfile):
+            os.remove(depfile)
+    store(cacheDir, key, unit, depends, result.stdout, result.stderr)
+    evict(cacheDir, maxSize)
+    return 0
+
+
+def main(argv: list[str]) -> int:
+    cacheDir = os.environ.get("UMAKE_BMI_CACHE_DIR", CACHE_DIR)
+    maxSize = int(os.environ.get("UMAKE_BMI_CACHE_SIZE", MAX_SIZE))
+    references: list[str] = []
+    i = 0
+    while i < len(argv):
+        if argv[i] == "--":
+            i += 1
+            break
+        elif argv[i] == "--cache-dir":
+            cacheDir = argv[i + 1]
+        elif argv[i] == "--max-size":
+            maxSize = int(argv[i + 1])
+        elif argv[i] == "--reference":
+            references.append(argv[i + 1])
+        else:
+            break
+        i += 2
+    compiler = argv[i:]
+    assert compiler, "Specify the compiler, please."
+    try:
+        return compile(cacheDir, maxSize, compiler, references)
+    except OSError as e:
+        print(f"bmicache: {e}, compiling without cache.", file=sys.stderr)
+        return subprocess.call(compiler)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
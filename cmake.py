@@ -1,70 +1,305 @@
 # Communicate with cmake
 from config import *
 from scan import *
+from collections import deque
 from typing import TextIO
 
 
+def headerUnitTarget(headerUnit: str) -> str:
+    """
+    Target name of a header unit, <header> from library or header relative to root.
+    """
+    if headerUnit.startswith("<"):
+        return "__header__." + headerUnit[1:-1].replace("/", "__")
+    return "__header__.local." + headerUnit.replace("/", "__").replace("\\", "__")
+
+
+def collectHeaderUnits(
+    modulesToBePreCompiledBySources: dict[str, modulesDependency],
+) -> dict[str, set[str]]:
+    """
+    Header units imported anywhere in the project, each with header units imported by itself.
+    """
+    headerUnits: dict[str, set[str]] = dict()
+    pending: deque[str] = deque()
+    for modules in modulesToBePreCompiledBySources.values():
+        pending.extend(modules.library)
+        pending.extend(modules.local)
+    while pending:
+        headerUnit = pending.popleft()
+        if headerUnit in headerUnits:
+            continue
+        headerUnits[headerUnit] = set()
+        if headerUnit in calculatedDependencies:
+            modules = calculatedDependencies[headerUnit][0]
+            headerUnits[headerUnit] = (modules.library | modules.local) - {headerUnit}
+            pending.extend(headerUnits[headerUnit])
+    return headerUnits
+
+
+def buildOrder(dependencies: dict[str, set[str]]) -> list[str]:
+    """
+    Sort in the order that everything is built after its dependencies.
+    """
+    built: list[str] = []
+    while len(built) < len(dependencies):
+        has_built_one_in_one_loop = False
+        for item, depended in sorted(dependencies.items()):
+            if item in built or any([dep not in built for dep in depended]):
+                # Dependencies not built or already built
+                continue
+            has_built_one_in_one_loop = True
+            built.append(item)
+
+        assert has_built_one_in_one_loop, "Cyclic imports among {}.".format(
+            set(dependencies.keys()) - set(built)
+        )
+    return built
+
+
+def sourcesInBuildOrder(
+    modulesToBePreCompiledBySources: dict[str, modulesDependency],
+) -> list[str]:
+    dependencies: dict[str, set[str]] = dict()
+    for source, modules in modulesToBePreCompiledBySources.items():
+        dependencies[source] = {modulesBiDict[module] for module in modules.module}
+        if source in implDict.inverse:
+            # Module implement's corresponding interface
+            dependencies[source].add(modulesBiDict[implDict.inverse[source]])
+    return buildOrder(dependencies)
+
+
+def referencedModules(modules: modulesDependency) -> list[str]:
+    """
+    Names of referenced modules, including their partitions.
+    """
+    references: list[str] = []
+    for module in sorted(modules.module):
+        if module in modulesBiDict.keys():
+            references.append(module)
+            if module in parDict:
+                references.extend(module + par for par in sorted(parDict[module]))
+    # A partition might be imported on its own as well
+    return list(dict.fromkeys(references))
+
+
+def dependedObjects(
+    source: str,
+    objectsDict: bidict[str, str],
+    extraSourcesBySources: dict[str, sourcesDependency],
+) -> list[str]:
+    return [
+        objectsDict[extraSource]
+        for extraSource in sorted(extraSourcesBySources[source].sources)
+        if extraSource != source
+    ]
+
+
+def write_header_units(out: TextIO, headerUnits: dict[str, set[str]]):
+    for headerUnit in buildOrder(headerUnits):
+        references = headerUnits[headerUnit]
+        out.write(f"HEADER_UNIT {headerUnitTarget(headerUnit)} ")
+        if headerUnit.startswith("<"):
+            out.write(f"SYSTEM {headerUnit[1:-1]} ")
+        else:
+            out.write(f"SOURCE {headerUnit} ")
+        if references:
+            out.write(f"REFERENCE ")
+            for reference in sorted(references):
+                out.write(f"{headerUnitTarget(reference)} ")
+        out.write(";\n")
+
+
 def write_cmake(
     out: TextIO,
     modulesToBePreCompiledBySources: dict[str, modulesDependency],
     objectsDict: bidict[str, str],
     extraSourcesBySources: dict[str, sourcesDependency],
 ):
+    # Every header unit is built once and before all its importers
+    write_header_units(out, collectHeaderUnits(modulesToBePreCompiledBySources))
 
-    built: list[str] = []
-    while len(built) < len(modulesToBePreCompiledBySources):
-        has_built_one_in_one_loop = False
-        for source, modules in modulesToBePreCompiledBySources.items():
-            depend = False
-            reference = False
-            if source in built or any(
-                [modulesBiDict[module] not in built for module in modules.module]
-            ):
-                # Dependencies not built or already built
-                continue
-            if (
-                source in implDict.inverse
-                and modulesBiDict[implDict.inverse[source]] not in built
-            ):
-                # Module implement's corresponding interface not built
+    records: list[str] = []
+    for source in sourcesInBuildOrder(modulesToBePreCompiledBySources):
+        modules = modulesToBePreCompiledBySources[source]
+        if source in modulesBiDict.inverse:
+            record = f"MODULE {modulesBiDict.inverse[source]} "
+        elif source in relSourcesToRoot:
+            record = f"TARGET {targetsBidict.inverse[source]} "
+        elif source in implDict.inverse:
+            record = f"IMPLEMENT {implDict.inverse[source]} "
+        else:
+            if not autoObj:
                 continue
+            record = f"OBJECT {objectsDict[source]} "
+        record += f"SOURCE {source} "
+        if source in modulesBiDict.inverse:
+            if modulesBiDict.inverse[source] in implDict.keys():
+                record += f"IMPLEMENT "
 
-            has_built_one_in_one_loop = True
-            if source in modulesBiDict.inverse:
-                out.write(f"MODULE {modulesBiDict.inverse[source]} ")
-            elif source in relSourcesToRoot:
-                out.write(f"TARGET {targetsBidict.inverse[source]} ")
-            elif source in implDict.inverse:
-                out.write(f"IMPLEMENT {implDict.inverse[source]} ")
-            else:
-                if not autoObj:
-                    continue
-                out.write(f"OBJECT {objectsDict[source]} ")
-            out.write(f"SOURCE {source} ")
-            if source in modulesBiDict.inverse:
-                if modulesBiDict.inverse[source] in implDict.keys():
-                    out.write(f"IMPLEMENT ")
-
-            for extraSourcesBySource in extraSourcesBySources[source].sources:
-                if extraSourcesBySource == source:
-                    continue
-                if not depend:
-                    out.write(f"DEPEND ")
-                    depend = True
-                out.write(f"{objectsDict[extraSourcesBySource]}")
-            for module in modules.module:
-                if module in modulesBiDict.keys():
-                    if not reference:
-                        out.write(f"REFERENCE ")
-                        reference = True
-                    out.write(f"{module} ")
-                    if module in parDict:
-                        for par in parDict[module]:
-                            out.write(f"{module + par} ")
-            built.append(source)
-            if len(built) < len(modulesToBePreCompiledBySources):
-                out.write(";\n")
+        depends = dependedObjects(source, objectsDict, extraSourcesBySources)
+        if depends:
+            record += "DEPEND " + "".join(f"{depend} " for depend in depends)
+        references = referencedModules(modules)
+        if references:
+            record += "REFERENCE " + "".join(f"{module} " for module in references)
+        headerUnits = modules.library | modules.local
+        if headerUnits:
+            record += "HEADER_UNIT " + "".join(
+                f"{headerUnitTarget(headerUnit)} " for headerUnit in sorted(headerUnits)
+            )
+        records.append(record)
+    out.write(";\n".join(records))
 
-        assert has_built_one_in_one_loop, "Cyclic imports among {}.".format(
-            set(modulesToBePreCompiledBySources.keys()) - set(built)
+
+def escapeModule(module: str) -> str:
+    return module.replace(":", "-")
+
+
+def quote(relFileToRoot: str) -> str:
+    return '"' + relFileToRoot.replace("\\", "/") + '"'
+
+
+def write_references(
+    out: TextIO,
+    target: str,
+    source: str,
+    references: list[str],
+    headerUnits: list[str],
+    linkImplements: bool,
+):
+    """
+    Same as referencing modules and header units in umake.cmake, but names are resolved here.
+    """
+    escapedReferences = " ".join(escapeModule(reference) for reference in references)
+    out.write("if(CXX_MODULES_REFERENCE_DIRECTORY)\n")
+    out.write(
+        f"    target_compile_options({target} PRIVATE ${{CXX_MODULES_REFERENCES_FLAG}}${{CXX_PRECOMPILED_MODULES_DIR}})\n"
+    )
+    if references:
+        out.write("else()\n")
+        out.write(f"    target_compile_options({target}\n        PRIVATE\n")
+        for reference in references:
+            out.write(
+                f"        ${{CXX_MODULES_REFERENCE_FLAG}}{reference}=${{CXX_PRECOMPILED_MODULES_DIR}}/{escapeModule(reference)}.${{CXX_PRECOMPILED_MODULES_EXT}}\n"
+            )
+        out.write("    )\n")
+    out.write("endif()\n")
+
+    if references:
+        libraries: list[str] = []
+        for reference in references:
+            libraries.append(escapeModule(reference))
+            implement = f"__impl__.{escapeModule(reference)}"
+            if linkImplements and reference in implDict.keys() and implement != target:
+                libraries.append(implement)
+        out.write(f"target_link_libraries({target} PUBLIC {' '.join(libraries)})\n")
+        out.write(f"add_dependencies({target} {escapedReferences})\n")
+        out.write("if(CXX_MODULES_PRECOMPILE_WHEN_COMPILE)\n")
+        out.write(
+            f"    set_property(SOURCE {quote(source)} APPEND PROPERTY OBJECT_DEPENDS\n"
+        )
+        for reference in references:
+            interface = modulesBiDict[reference].replace("\\", "/")
+            out.write(
+                f'        "${{CMAKE_CURRENT_BINARY_DIR}}/CMakeFiles/{escapeModule(reference)}.dir/{interface}${{CMAKE_CXX_OUTPUT_EXTENSION}}"\n'
+            )
+        out.write("    )\nendif()\n")
+
+    for headerUnit in headerUnits:
+        out.write(
+            f"target_add_header_unit_dependencies({target} {headerUnitTarget(headerUnit)} {quote(source)})\n"
         )
+
+
+def write_cmake_script(
+    out: TextIO,
+    modulesToBePreCompiledBySources: dict[str, modulesDependency],
+    objectsDict: bidict[str, str],
+    extraSourcesBySources: dict[str, sourcesDependency],
+):
+    """
+    Write a script to be included by cmake, with the same targets as write_cmake.
+    """
+    out.write("# Generated by umake.py, do not edit.\n")
+    out.write("# Include it with add_moduled_*_from_script in umake.cmake.\n")
+
+    headerUnits = collectHeaderUnits(modulesToBePreCompiledBySources)
+    if headerUnits:
+        out.write("\n")
+    for headerUnit in buildOrder(headerUnits):
+        out.write(f"add_header_unit({headerUnitTarget(headerUnit)} ")
+        if headerUnit.startswith("<"):
+            out.write(f"SYSTEM {headerUnit[1:-1]}")
+        else:
+            out.write(f"SOURCE {quote(headerUnit)}")
+        references = sorted(headerUnits[headerUnit])
+        if references:
+            out.write(" REFERENCE")
+            for reference in references:
+                out.write(f" {headerUnitTarget(reference)}")
+        out.write(")\n")
+
+    for source in sourcesInBuildOrder(modulesToBePreCompiledBySources):
+        modules = modulesToBePreCompiledBySources[source]
+        depends = dependedObjects(source, objectsDict, extraSourcesBySources)
+        references = referencedModules(modules)
+        headerUnits = sorted(modules.library | modules.local)
+
+        if source in modulesBiDict.inverse:
+            module = modulesBiDict.inverse[source]
+            target = escapeModule(module)
+            out.write(f"\n# Module {module}\n")
+            out.write(
+                f"set_source_files_properties({quote(source)} PROPERTIES LANGUAGE CXX)\n"
+            )
+            out.write(
+                f"add_library({target} ${{UMAKE_MODULE_LIBRARY_TYPE}} {quote(source)})\n"
+            )
+            write_references(out, target, source, references, headerUnits, False)
+            hasImplement = "TRUE" if module in implDict.keys() else "FALSE"
+            out.write(
+                f'precompile_module_interface({module} {quote(source)} "{";".join(references)}" "{";".join(headerUnitTarget(headerUnit) for headerUnit in headerUnits)}" {hasImplement})\n'
+            )
+            continue
+
+        isObject = False
+        if source in relSourcesToRoot:
+            target = targetsBidict.inverse[source]
+            out.write(f"\n# Target {target}\n")
+            out.write("if(UMAKE_TARGETS_AS_LIBRARIES)\n")
+            out.write(f"    add_library({target} ${{UMAKE_LIBRARY_TYPE}})\n")
+            out.write("else()\n")
+            out.write(f"    add_executable({target})\n")
+            out.write("endif()\n")
+            out.write(f"target_sources({target} PRIVATE {quote(source)})\n")
+            out.write(
+                f"target_compile_options({target} PRIVATE ${{CXX_MODULES_FLAGS}})\n"
+            )
+        elif source in implDict.inverse:
+            module = implDict.inverse[source]
+            target = f"__impl__.{escapeModule(module)}"
+            out.write(f"\n# Implement of module {module}\n")
+            out.write(
+                f"set_source_files_properties({quote(source)} PROPERTIES LANGUAGE CXX)\n"
+            )
+            out.write(f"add_library({target} STATIC {quote(source)})\n")
+            out.write(f"add_dependencies({target} {escapeModule(module)})\n")
+            # Implement imports its interface implicitly
+            references = references + [module]
+        else:
+            if not autoObj:
+                continue
+            isObject = True
+            target = objectsDict[source]
+            out.write(f"\n# Object {target}\n")
+            out.write(f"add_library({target} STATIC {quote(source)})\n")
+            out.write(
+                f"target_compile_options({target} PRIVATE ${{CXX_MODULES_FLAGS}})\n"
+            )
+
+        if depends:
+            if not isObject:
+                out.write(f"add_dependencies({target} {' '.join(depends)})\n")
+            out.write(f"target_link_libraries({target} PUBLIC {' '.join(depends)})\n")
+        write_references(out, target, source, references, headerUnits, True)
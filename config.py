@@ -1,12 +1,34 @@
 import argparse
 from bidict import bidict
 import json
+import os
 import os.path as path
+import re
 from sys import argv
+from typing import Any, Optional
 
 CONFIG_PATH = "umakeConfig.json"
 
 
+def isUnder(relPath: str, relFolder: str) -> bool:
+    relPathToFolder = path.relpath(relPath, relFolder)
+    return relPathToFolder != path.pardir and not relPathToFolder.startswith(
+        path.pardir + path.sep
+    )
+
+
+# Options only meant for a single run, which are not saved
+TRANSIENT_OPTIONS = [
+    "affected_by",
+    "batch",
+    "cache_action",
+    "merge",
+    "shard",
+    "fragments",
+    "report_top",
+]
+
+
 def loadConfig(args: argparse.Namespace, relRoot: str, default: argparse.Namespace):
     configPath = path.join(args.root, CONFIG_PATH)
     if not path.exists(configPath):
@@ -14,6 +36,9 @@ def loadConfig(args: argparse.Namespace, relRoot: str, default: argparse.Namespa
     with open(configPath) as config:
         cfg = json.load(config)
         for key, value in cfg.items():
+            # Saved by earlier versions
+            if key in TRANSIENT_OPTIONS:
+                continue
             if (
                 key not in vars(args).keys()
                 or key not in vars(default).keys()
@@ -33,7 +58,14 @@ def saveConfig(args: argparse.Namespace):
     vars(args)["root"] = path.relpath(vars(args)["root"])
     vars(args)["folders"] = [path.relpath(folder) for folder in vars(args)["folders"]]
     with open(path.join(args.root, CONFIG_PATH), "w") as config:
-        json.dump(vars(args), config)
+        json.dump(
+            {
+                key: value
+                for key, value in vars(args).items()
+                if key not in TRANSIENT_OPTIONS
+            },
+            config,
+        )
 
 
 parser = argparse.ArgumentParser()
@@ -124,9 +156,80 @@ parser.add_argument(
     help="Ask umake to read and load umakeConfig.json on root. Configuration will be preferred unless not given.",
 )
 parser.add_argument("--no-cache", action="store_true", help="Disable scanning caches")
+parser.add_argument(
+    "--cache-dir",
+    type=str,
+    default=os.environ.get("UMAKE_CACHE_DIR"),
+    help="Directory of scanning cache shared among roots, build trees and worktrees, keyed by content. $UMAKE_CACHE_DIR by default. Not shared unless given.",
+)
 parser.add_argument(
     "--log-update", action="store_true", help="Log when cache is updated."
 )
+parser.add_argument(
+    "--log-max-size",
+    type=int,
+    default=1 << 20,
+    help="Size in bytes above which umakeLog.txt is rotated. 0 disables rotation.",
+)
+parser.add_argument(
+    "--log-backups",
+    type=int,
+    default=3,
+    help="Number of rotated logs to be kept.",
+)
+parser.add_argument(
+    "--affected-by",
+    type=str,
+    nargs="+",
+    default=[],
+    help="Print modules, objects and targets affected by given changed files according to the last run, without scanning. Those only to be relinked are marked with RELINK, and names are prefixed with their roots after running in batch.",
+)
+parser.add_argument(
+    "--batch",
+    type=str,
+    help='Path to a JSON manifest of roots like [{"root": <ROOT>, "sources": [<TARGET_NAME1>, <SOURCE1>, ...], "folders": [<FOLDER1>, ...]}, ...], relative to --root. Folders of all roots are scanned once, and output of every root is written under it.',
+)
+parser.add_argument(
+    "--prefetch-depth",
+    type=int,
+    default=0,
+    help="Number of files to be stated and read ahead of the scanner. 0 disables prefetching.",
+)
+parser.add_argument(
+    "--prefetch-workers",
+    type=int,
+    default=4,
+    help="Number of threads prefetching files when prefetching is enabled.",
+)
+parser.add_argument(
+    "--shard",
+    type=str,
+    help="Scan only files in shard i of N (0 <= i < N) like 0/4, and write a cache fragment on root instead of output. Fragments of all shards are combined with --merge.",
+)
+parser.add_argument(
+    "--cache",
+    choices=["stats", "gc", "verify"],
+    dest="cache_action",
+    help="Manage scanning cache on root instead of scanning: show what is cached and counts of the last run, evict results of missing files, or scan files again and compare results with cache.",
+)
+parser.add_argument(
+    "--merge",
+    action="store_true",
+    help="Combine cache fragments written with --shard instead of scanning, then collect dependencies as usual.",
+)
+parser.add_argument(
+    "--fragments",
+    type=str,
+    nargs="*",
+    default=[],
+    help="Cache fragments to be combined with --merge. All fragments on root by default.",
+)
+parser.add_argument(
+    "--report-top",
+    type=int,
+    default=0,
+    help="Number of files in report of report and report-dot targets, the most expensive to change first. 0 for all.",
+)
 args = parser.parse_args()
 default = parser.parse_args([])
 _loadConfig = args.load_config
@@ -140,6 +243,7 @@ relRoot = path.relpath(root)
 if _loadConfig:
     loadConfig(args, relRoot, default)
 
+foldersGiven = bool(args.folders)
 if not args.folders:
     args.folders = [args.root]
 
@@ -164,11 +268,47 @@ folders: list[str] = args.folders
 relFoldersToCur = [
     path.relpath(path.join(relRoot, path.relpath(folder))) for folder in folders
 ]
+affectedBy: list[str] = args.affected_by
+batchManifest: Optional[str] = args.batch
+batchEntries: list[dict[str, Any]] = []
+if batchManifest:
+    with open(batchManifest) as manifest:
+        batchEntries = json.load(manifest)
+    assert isinstance(batchEntries, list), "Batch manifest should be a list of roots."
+    if not foldersGiven:
+        # Scan folders shared by roots only once
+        relFoldersToCur = []
+        for relFolderToCur in sorted(
+            {
+                path.relpath(path.join(relRoot, entry["root"], folder))
+                for entry in batchEntries
+                for folder in entry.get("folders", [path.curdir])
+            }
+        ):
+            if not any(isUnder(relFolderToCur, scanned) for scanned in relFoldersToCur):
+                relFoldersToCur.append(relFolderToCur)
+merging: bool = args.merge
+cacheAction: Optional[str] = args.cache_action
+shard: Optional[tuple[int, int]] = None
+if args.shard:
+    shardMatch = re.fullmatch(r"(\d+)/(\d+)", args.shard)
+    assert shardMatch and int(shardMatch[1]) < int(
+        shardMatch[2]
+    ), f'Shard should be like i/N where 0 <= i < N, but got "{args.shard}".'
+    shard = (int(shardMatch[1]), int(shardMatch[2]))
+    assert not merging, "Shard can't be given with --merge."
+relFragmentsToCur: list[str] = [path.relpath(fragment) for fragment in args.fragments]
+reportTop: int = args.report_top
 moduleExtension: list[str] = args.module
 excludeFiles = args.exclude_files
 excludeDirs = args.exclude_dirs
 cacheDisabled: bool = args.no_cache
+sharedCacheDir: Optional[str] = args.cache_dir
 logUpdate: bool = args.log_update
+logMaxSize: int = args.log_max_size
+logBackups: int = args.log_backups
+prefetchDepth: int = args.prefetch_depth
+prefetchWorkers: int = args.prefetch_workers
 
 relOutToRoot: str
 if "output" in args:
@@ -177,11 +317,12 @@ elif target == "info-only":
     relOutToRoot = "umakeGenerated.txt"
 elif target == "cmake-script":
     relOutToRoot = "umakeGenerated.cmake"
-elif target.startswith("cmake"):
+elif target and target.startswith("cmake"):
     relOutToRoot = "umakeGenerated.txt"
 else:
     relOutToRoot = "umakeGenerated.txt"
 relOutToCur: str = path.join(root, relOutToRoot)
+CONFIGURE_DEPENDS_PATH = "umakeConfigureDepends.txt"
 
 autoObj = not args.no_auto_obj
 extHeaders: set[str] = set(args.ext_header)
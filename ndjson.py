@@ -0,0 +1,119 @@
+# Stream results as newline-delimited JSON, one record per line
+from config import *
+from scan import *
+from cmake import collectHeaderUnits, dependedObjects, referencedModules
+from typing import Any, TextIO
+import json
+import os.path as path
+
+# Increased on incompatible changes of records
+NDJSON_VERSION = 1
+
+# Set once the consumer stops reading, such as "umake.py --target ndjson | head -1"
+readerGone = False
+
+
+def write_record(out: TextIO, type: str, **fields: Any):
+    """
+    Records after the consumer is gone are dropped, while scanning goes on
+    so that the cache is still saved.
+    """
+    global readerGone
+    if readerGone:
+        return
+    try:
+        out.write(json.dumps(dict(type=type, **fields), sort_keys=True) + "\n")
+        # Consumers may start working before scanning completes
+        out.flush()
+    except OSError:
+        readerGone = True
+        discardOutput(out)
+
+
+def write_ndjson_header(out: TextIO, relRootToCur: str):
+    write_record(
+        out,
+        "header",
+        format="umake-ndjson",
+        version=NDJSON_VERSION,
+        root=path.abspath(relRootToCur),
+    )
+
+
+def write_ndjson_file(out: TextIO, relFileToRoot: str, info: dependency, origin: str):
+    """
+    Paths are relative to root, header units from library are kept as <header>.
+    """
+    relDirToRoot = path.dirname(relFileToRoot)
+    write_record(
+        out,
+        "file",
+        path=relFileToRoot,
+        origin=origin,
+        provide=info.provide,
+        implement=info.implement,
+        includes=dict(
+            library=sorted(info.headers.library),
+            local=sorted(
+                path.normpath(path.join(relDirToRoot, relIncludedToSrc))
+                for relIncludedToSrc in info.headers.local
+            ),
+        ),
+        imports=dict(
+            modules=sorted(info.modules.module),
+            headerUnits=sorted(
+                resolveHeaderUnit(relDirToRoot, imported)
+                for imported in info.modules.library | info.modules.local
+            ),
+        ),
+        sources=sorted(info.sources.sources),
+    )
+
+
+def write_ndjson_graph(
+    out: TextIO,
+    modulesToBePreCompiledBySources: dict[str, modulesDependency],
+    objectsDict: bidict[str, str],
+    extraSourcesBySources: dict[str, sourcesDependency],
+):
+    """
+    Units to build after closure completes, each with all units it depends on.
+    """
+    headerUnits = collectHeaderUnits(modulesToBePreCompiledBySources)
+    for headerUnit, references in sorted(headerUnits.items()):
+        write_record(
+            out,
+            "headerUnit",
+            name=headerUnit,
+            system=headerUnit.startswith("<"),
+            references=sorted(references),
+        )
+
+    units = 0
+    for source, modules in sorted(modulesToBePreCompiledBySources.items()):
+        if source in modulesBiDict.inverse:
+            kind, name = "module", modulesBiDict.inverse[source]
+        elif source in relSourcesToRoot:
+            kind, name = "target", targetsBidict.inverse[source]
+        elif source in implDict.inverse:
+            kind, name = "implement", implDict.inverse[source]
+        elif autoObj:
+            kind, name = "object", objectsDict[source]
+        else:
+            continue
+        write_record(
+            out,
+            "unit",
+            kind=kind,
+            name=name,
+            source=source,
+            depends=dependedObjects(source, objectsDict, extraSourcesBySources),
+            references=referencedModules(modules),
+            headerUnits=sorted(modules.library | modules.local),
+        )
+        units += 1
+    write_record(out, "end", files=len(depsDict), units=units)
+
+
+def write_ndjson_error(out: TextIO, message: str):
+    write_record(out, "error", message=message)
@@ -0,0 +1,235 @@
+# Rank files by how much rebuilding they cause when changed
+from config import *
+from scan import *
+from typing import Any, Iterator, TextIO
+import json
+import os.path as path
+
+# Increased on incompatible changes of reports
+REPORT_VERSION = 1
+
+
+def fileGraph() -> dict[str, set[str]]:
+    """
+    Scanned files with scanned files they include or import directly.
+    """
+    modules = {
+        dep.provide: relFileToRoot
+        for relFileToRoot, dep in depsDict.items()
+        if dep.provide
+    }
+    return {
+        relFileToRoot: {
+            relDependedToRoot
+            for relDependedToRoot in dependedFiles(relFileToRoot, dep, modules)
+            if relDependedToRoot in depsDict and relDependedToRoot != relFileToRoot
+        }
+        for relFileToRoot, dep in depsDict.items()
+    }
+
+
+def condense(graph: dict[str, set[str]]) -> list[list[str]]:
+    """
+    Strongly connected components by Tarjan's algorithm,
+    each after all components it depends on, as headers may include each other.
+    """
+    index: dict[str, int] = dict()
+    low: dict[str, int] = dict()
+    stack: list[str] = []
+    onStack: set[str] = set()
+    components: list[list[str]] = []
+
+    def visit(node: str) -> tuple[str, Iterator[str]]:
+        index[node] = low[node] = len(index)
+        stack.append(node)
+        onStack.add(node)
+        return node, iter(sorted(graph[node]))
+
+    for start in sorted(graph):
+        if start in index:
+            continue
+        # Iterative, as include chains might be deeper than recursion limit
+        work = [visit(start)]
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in index:
+                    work.append(visit(child))
+                    break
+                if child in onStack:
+                    low[node] = min(low[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    component: list[str] = []
+                    while not component or component[-1] != node:
+                        component.append(stack.pop())
+                        onStack.remove(component[-1])
+                    components.append(sorted(component))
+    return components
+
+
+def bits(x: int) -> Iterator[int]:
+    digits = bin(x)[:1:-1]
+    i = digits.find("1")
+    while i != -1:
+        yield i
+        i = digits.find("1", i + 1)
+
+
+def fileKind(relFileToRoot: str, dep: dependency, ext: extensionMapper) -> str:
+    if dep.provide:
+        return "module"
+    if dep.implement:
+        return "implement"
+    extName = path.splitext(relFileToRoot)[1]
+    if extName in ext.sources or extName in ext.head_source_pairs.values():
+        return "source"
+    return "header"
+
+
+def collectHotspots(relRootToCur: str, ext: extensionMapper) -> list[dict[str, Any]]:
+    """
+    Metrics of every scanned file, the most expensive to change first.
+    Compiling a unit is estimated to cost the size of itself and all headers it reaches,
+    and changing a file costs compiling all units reaching it, including itself.
+    """
+    graph = fileGraph()
+    components = condense(graph)
+    componentOf = {
+        relFileToRoot: c
+        for c, component in enumerate(components)
+        for relFileToRoot in component
+    }
+    sizes: dict[str, int] = dict()
+    for relFileToRoot in graph:
+        relFileToCur = path.join(relRootToCur, relFileToRoot)
+        sizes[relFileToRoot] = (
+            path.getsize(relFileToCur) if path.exists(relFileToCur) else 0
+        )
+    kinds = {
+        relFileToRoot: fileKind(relFileToRoot, dep, ext)
+        for relFileToRoot, dep in depsDict.items()
+    }
+    headerSizes = [
+        sum(sizes[f] for f in component if kinds[f] == "header")
+        for component in components
+    ]
+
+    # Components reached by every component as bit sets
+    below: list[int] = []
+    depths: list[int] = []
+    for c, component in enumerate(components):
+        reached = 0
+        depth = 0
+        for relFileToRoot in component:
+            for relDependedToRoot in graph[relFileToRoot]:
+                d = componentOf[relDependedToRoot]
+                if d != c:
+                    reached |= below[d] | (1 << d)
+                    depth = max(depth, depths[d] + 1)
+        below.append(reached)
+        depths.append(depth)
+
+    closures = [len(component) - 1 for component in components]
+    closureHeaderSizes = list(headerSizes)
+    for c in range(len(components)):
+        for d in bits(below[c]):
+            closures[c] += len(components[d])
+            closureHeaderSizes[c] += headerSizes[d]
+
+    # Every unit costs all files it reaches
+    unitCosts = [
+        sum(sizes[f] + closureHeaderSizes[c] for f in component if kinds[f] != "header")
+        for c, component in enumerate(components)
+    ]
+    fanIns = [len(component) - 1 for component in components]
+    rebuildCosts = list(unitCosts)
+    for c, component in enumerate(components):
+        for d in bits(below[c]):
+            fanIns[d] += len(component)
+            rebuildCosts[d] += unitCosts[c]
+
+    directFanIns: dict[str, int] = {relFileToRoot: 0 for relFileToRoot in graph}
+    for depended in graph.values():
+        for relDependedToRoot in depended:
+            directFanIns[relDependedToRoot] += 1
+
+    hotspots: list[dict[str, Any]] = []
+    for relFileToRoot, dep in depsDict.items():
+        c = componentOf[relFileToRoot]
+        hotspots.append(
+            dict(
+                path=relFileToRoot,
+                kind=kinds[relFileToRoot],
+                module=dep.provide or dep.implement,
+                size=sizes[relFileToRoot],
+                directFanIn=directFanIns[relFileToRoot],
+                fanIn=fanIns[c],
+                closure=closures[c],
+                depth=depths[c],
+                rebuildCost=rebuildCosts[c],
+                cycle=components[c] if len(components[c]) > 1 else [],
+            )
+        )
+    hotspots.sort(
+        key=lambda hotspot: (
+            -hotspot["rebuildCost"],
+            -hotspot["fanIn"],
+            hotspot["path"],
+        )
+    )
+    return hotspots
+
+
+def write_report_json(out: TextIO, hotspots: list[dict[str, Any]], top: int):
+    json.dump(
+        dict(
+            version=REPORT_VERSION,
+            files=len(hotspots),
+            hotspots=hotspots[:top] if top > 0 else hotspots,
+        ),
+        out,
+        indent=2,
+    )
+    out.write("\n")
+
+
+def dotString(s: str) -> str:
+    # Escapes of JSON strings are understood by Graphviz
+    return json.dumps(s, ensure_ascii=False)
+
+
+def write_report_dot(out: TextIO, hotspots: list[dict[str, Any]], top: int):
+    """
+    Files as nodes, filled redder when more expensive to change,
+    and edges from files to what they include or import.
+    """
+    shown = hotspots[:top] if top > 0 else hotspots
+    names = {hotspot["path"] for hotspot in shown}
+    maxCost = max([hotspot["rebuildCost"] for hotspot in shown] + [1])
+    out.write("digraph umake {\n")
+    out.write("    node [shape=box, style=filled];\n")
+    for hotspot in shown:
+        label = "\n".join(
+            [
+                hotspot["path"]
+                + (f" ({hotspot['module']})" if hotspot["module"] else ""),
+                f"fan-in {hotspot['fanIn']}, closure {hotspot['closure']}, depth {hotspot['depth']}",
+                f"rebuild cost {hotspot['rebuildCost']} B",
+            ]
+        )
+        saturation = hotspot["rebuildCost"] / maxCost
+        out.write(
+            f'    {dotString(hotspot["path"])} [label={dotString(label)}, fillcolor="0.000 {saturation:.3f} 1.000"];\n'
+        )
+    graph = fileGraph()
+    for relFileToRoot in sorted(names):
+        for relDependedToRoot in sorted(graph[relFileToRoot] & names):
+            out.write(
+                f"    {dotString(relFileToRoot)} -> {dotString(relDependedToRoot)};\n"
+            )
+    out.write("}\n")
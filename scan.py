@@ -5,9 +5,14 @@ Written by TheVeryDarkness, 1853308@tongji.edu.cn on Github.
 from __future__ import annotations
 from sys import stderr
 
-from typing import Any, Optional, Union
+from typing import IO, Any, Callable, Iterable, Iterator, Optional, Union
+from contextlib import contextmanager
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
 from bidict import bidict
 from colorama import Fore, init
+import hashlib
 import json
 import os
 import os.path as path
@@ -25,6 +30,7 @@ linesep = '\n'
 
 VERBOSITY_SHOW_STACKTRACE = 1
 VERBOSITY_SCANNING_FILE = 1
+VERBOSITY_SCANNING_STATISTICS = 1
 VERBOSITY_MODIFIED_FILE = 2
 VERBOSITY_UNMODIFIED_FILE = 3
 VERBOSITY_EXCLUDE_DIRECTORY = 4
@@ -67,7 +73,7 @@ class modulesDependency:
     def unionWith(self, newDeps: modulesDependency):
         self.module = self.module.union(newDeps.module)
         self.library = self.library.union(newDeps.library)
-        self.local = self.library.union(newDeps.local)
+        self.local = self.local.union(newDeps.local)
 
     def contain(self, module: set[str], library: set[str], local: set[str]) -> bool:
         return self.module.issuperset(module) and self.library.issuperset(library) and self.local.issuperset(local)
@@ -145,6 +151,9 @@ depsDict: dict[str, dependency] = dict()
 # cache of depsDict
 global depsDictCache
 depsDictCache: dict[str, dependency] = dict()
+# cached entries of files not walked in this run, which are saved again
+global retainedDepsDict
+retainedDepsDict: dict[str, dependency] = dict()
 # main module name --> partitions' name
 global parDict
 parDict: dict[str, set[str]] = dict()
@@ -152,13 +161,59 @@ parDict: dict[str, set[str]] = dict()
 global implDict
 implDict: bidict[str, str] = bidict()
 
+# relative path to root directory of files whose cached or scanned results can't be trusted
+global dirtyFiles
+dirtyFiles: set[str] = set()
+# relative path to root directory of dirty files that are removed --> file depending on it
+global removedDependencies
+removedDependencies: dict[str, Optional[str]] = dict()
+
+# content hash --> dependencies shared among roots, without time and sources
+# None if shared cache is disabled
+global sharedDepsDict
+sharedDepsDict: Optional[dict[str, dict[str, Any]]] = None
+# absolute path --> (modification time, content hash)
+global sharedPathsDict
+sharedPathsDict: dict[str, tuple[float, str]] = dict()
+# entries of shared cache added in this run
+global sharedDepsPending
+sharedDepsPending: dict[str, dict[str, Any]] = dict()
+global sharedPathsPending
+sharedPathsPending: dict[str, tuple[float, str]] = dict()
+
+# relative path of walked directory to current directory --> file name without extension --> extension names
+global extNamesByStems
+extNamesByStems: dict[str, dict[str, set[str]]] = dict()
+
 LOG_PATH = "umakeLog.txt"
 
+# entries to be appended to the log, as JSON lines
+global logEntries
+logEntries: list[dict[str, Any]] = []
+# event name --> count of files in this run
+global logCounts
+logCounts: dict[str, int] = dict()
+
+# Called with relFileToRoot, its dependency and where it comes from ("scanned", "cache" or "shared"),
+# as soon as a file is scanned or served from cache
+global fileListeners
+fileListeners: list[Callable[[str, dependency, str], None]] = []
+
 global calculatedDependencies
 calculatedDependencies: dict[str,
                              tuple[modulesDependency, sourcesDependency]] = dict()
 
 
+def resolveHeaderUnit(relSrcDirToRoot: str, imported: str) -> str:
+    '''
+    Local header units are scanned as "header" relative to the importing file, and resolved to root once collected.
+    Header units from library are kept as <header>.
+    '''
+    if imported.startswith('"'):
+        return path.normpath(path.join(relSrcDirToRoot, imported[1:-1]))
+    return imported
+
+
 def __collectDependencies(relFileToRoot: str, relRootToCur: str, verbosity: int, encoding: str, ext: extensionMapper, logUpdate: bool, touched: set[str]) -> tuple[modulesDependency, sourcesDependency]:
     if relFileToRoot in calculatedDependencies:
         return calculatedDependencies[relFileToRoot]
@@ -170,17 +225,19 @@ def __collectDependencies(relFileToRoot: str, relRootToCur: str, verbosity: int,
 
 
 def recursiveCollectDependencies(relSrcToCur: str, relRootToCur: str, verbosity: int, encoding: str, ext: extensionMapper, logUpdate: bool, touched: set[str]) -> tuple[modulesDependency, sourcesDependency]:
+    relSrcToRoot = path.relpath(relSrcToCur, relRootToCur)
+    dirtyBefore = len(dirtyFiles)
     try:
-        relSrcToRoot = path.relpath(relSrcToCur, relRootToCur)
-
         relSrcDirToRoot = path.dirname(relSrcToRoot)
 
         assert relSrcToRoot not in touched, f"{relSrcToCur} indirectly dependended by itself."
         touched.add(relSrcToRoot)
 
         deps = depsDict[relSrcToRoot]
-        importedModules = deps.modules
-        dependedSources = deps.sources
+        # Collected into a copy, as resolved header units are relative to root
+        importedHeaderUnits = {resolveHeaderUnit(relSrcDirToRoot, imported) for imported in deps.modules.local}
+        importedModules = modulesDependency(set(deps.modules.module), set(deps.modules.library), set(importedHeaderUnits))
+        dependedSources = sourcesDependency(set(deps.sources.sources))
         for relIncludedToSrc in depsDict[relSrcToRoot].headers.local:
             assert not path.isabs(relIncludedToSrc)
             relIncludedToRoot = path.relpath(
@@ -188,6 +245,13 @@ def recursiveCollectDependencies(relSrcToCur: str, relRootToCur: str, verbosity:
             newImported, newSources = __collectDependencies(
                 relIncludedToRoot, relRootToCur, verbosity, encoding, ext, logUpdate, touched)
 
+            importedModules.unionWith(newImported)
+            dependedSources.unionWith(newSources)
+        # Local header units are depended like included headers
+        for relHeaderUnitToRoot in importedHeaderUnits:
+            newImported, newSources = __collectDependencies(
+                relHeaderUnitToRoot, relRootToCur, verbosity, encoding, ext, logUpdate, touched)
+
             importedModules.unionWith(newImported)
             dependedSources.unionWith(newSources)
         if deps.provide is not None:
@@ -224,14 +288,95 @@ def recursiveCollectDependencies(relSrcToCur: str, relRootToCur: str, verbosity:
             importedModules, dependedSources)
         return importedModules, dependedSources
     except:
+        # Only the innermost failing file is blamed
+        if len(dirtyFiles) == dirtyBefore:
+            dirtyFiles.add(relSrcToRoot)
+            if not path.exists(relSrcToCur):
+                removedDependencies[relSrcToRoot] = None
+        else:
+            # The file depending on a removed one is blamed as well
+            for relRemovedToRoot, relDependentToRoot in removedDependencies.items():
+                if relDependentToRoot is None:
+                    removedDependencies[relRemovedToRoot] = relSrcToRoot
+                    dirtyFiles.add(relSrcToRoot)
         print(YELLOW + f"In file {relSrcToCur}:" + RESET, file=stderr)
         raise
 
 
-def scanAllFiles(relProjToCur: str, relRootToCur: str, excludeFiles: set[str], excludeDirs: set[str], encoding, extMapper: extensionMapper, moduleExtension: set[str], verbosity: int, logUpdate: bool) -> None:
+class prefetchedFile:
+    def __init__(self, relFileToCur: str, mtime: Optional[float], data: Optional[bytes]) -> None:
+        '''
+        mtime is None if the file doesn't exist,
+        and data is None if the file is not read as its cache is still valid.
+        '''
+        self.relFileToCur = relFileToCur
+        self.mtime = mtime
+        self.data = data
+
+    def __repr__(self) -> str:
+        return str(vars(self))
+
+
+def prefetchFile(relFileToCur: str, relRootToCur: str, force: bool = False) -> prefetchedFile:
+    try:
+        mtime = os.stat(relFileToCur).st_mtime
+    except FileNotFoundError:
+        return prefetchedFile(relFileToCur, None, None)
+    relFileToRoot = path.relpath(relFileToCur, relRootToCur)
+    if not force and relFileToRoot in depsDictCache and depsDictCache[relFileToRoot].time > mtime:
+        return prefetchedFile(relFileToCur, mtime, None)
+    with open(relFileToCur, 'rb') as file:
+        return prefetchedFile(relFileToCur, mtime, file.read())
+
+
+def prefetchFiles(relFilesToCur: list[str], relRootToCur: str, depth: int, workers: int) -> Iterator[prefetchedFile]:
+    '''
+    Yield files in given order, while at most depth files are stated and read ahead by worker threads.
+    '''
+    if depth <= 0:
+        for relFileToCur in relFilesToCur:
+            yield prefetchFile(relFileToCur, relRootToCur)
+        return
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        pending: deque[Future[prefetchedFile]] = deque()
+        remaining = iter(relFilesToCur)
+        for relFileToCur in islice(remaining, depth):
+            pending.append(pool.submit(
+                prefetchFile, relFileToCur, relRootToCur))
+        try:
+            while pending:
+                prefetched = pending.popleft().result()
+                for relFileToCur in islice(remaining, 1):
+                    pending.append(pool.submit(
+                        prefetchFile, relFileToCur, relRootToCur))
+                yield prefetched
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def inShard(relFileToRoot: str, shard: tuple[int, int]) -> bool:
+    '''
+    Files are partitioned by hash of their paths,
+    so that every node picks the same files whatever the walking order is.
+    '''
+    index, count = shard
+    digest = hashlib.sha256(relFileToRoot.replace('\\', '/').encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % count == index
+
+
+def scanAllFiles(relProjToCur: str, relRootToCur: str, excludeFiles: set[str], excludeDirs: set[str], encoding, extMapper: extensionMapper, moduleExtension: set[str], verbosity: int, logUpdate: bool, prefetchDepth: int = 0, prefetchWorkers: int = 1, shard: Optional[tuple[int, int]] = None) -> None:
+    relFilesToCur: list[str] = []
     for dir, dirs, files in os.walk(relProjToCur):
         relDirToCur = path.relpath(dir)
         relDirToRoot = path.relpath(relDirToCur, relRootToCur)
+        # Directory is recorded as walked even if nothing in it is indexed
+        extNamesByStem = extNamesByStems.setdefault(relDirToCur, dict())
+        for file in files:
+            stem, extName = path.splitext(file)
+            # Only sources are looked up when pairing, skip the rest to save memory
+            if extName in extMapper.sources or extName in extMapper.head_source_pairs.values():
+                extNamesByStem.setdefault(stem, set()).add(extName)
         for excludeDir in excludeDirs:
             if path.exists(relDirToRoot) and path.exists(excludeDir) and path.samefile(relDirToRoot, excludeDir):
                 if verbosity >= VERBOSITY_EXCLUDE_DIRECTORY:
@@ -256,270 +401,512 @@ def scanAllFiles(relProjToCur: str, relRootToCur: str, excludeFiles: set[str], e
                         f"Walked-through file \"{relFileToCur}\" has a different extension name, skipped."
                     )
                 continue
-            try:
-                scanFileDependencies(relFileToCur, relRootToCur,
-                                     verbosity, encoding, extMapper, logUpdate)
-            except:
-                print(f"In file {relFileToCur}:", file=stderr)
-                raise
+            if shard is not None and not inShard(relFileToRoot, shard):
+                continue
+            relFilesToCur.append(relFileToCur)
 
+    begin = time.perf_counter()
+    scannedBytes = 0
+    for prefetched in prefetchFiles(relFilesToCur, relRootToCur, prefetchDepth, prefetchWorkers):
+        if prefetched.data is not None:
+            scannedBytes += len(prefetched.data)
+        try:
+            scanFileDependencies(prefetched.relFileToCur, relRootToCur,
+                                 verbosity, encoding, extMapper, logUpdate, prefetched)
+        except:
+            dirtyFiles.add(path.relpath(
+                prefetched.relFileToCur, relRootToCur))
+            print(f"In file {prefetched.relFileToCur}:", file=stderr)
+            raise
+    elapsed = time.perf_counter() - begin
+    if verbosity >= VERBOSITY_SCANNING_STATISTICS and elapsed > 0:
+        megabytes = scannedBytes / (1 << 20)
+        print(
+            CYAN + f"Scanned {len(relFilesToCur)} files ({megabytes:.2f} MB read) in \"{relProjToCur}\" within {elapsed:.3f}s, {len(relFilesToCur) / elapsed:.1f} files/s, {megabytes / elapsed:.2f} MB/s." + RESET)
+
+
+def __pairSources(relSrcToCur: str, relRootToCur: str, ext: extensionMapper) -> set[str]:
+    '''
+    Sources corresponding to a header, relative to root.
+    '''
+    relSourcesToRoot: set[str] = set()
+    relSrcSplitedHeadToCur, extName = path.splitext(relSrcToCur)
+    if extName not in ext.headers and extName not in ext.head_source_pairs.keys():
+        return relSourcesToRoot
+    relDirToCur = path.dirname(relSrcToCur) or path.curdir
+    if relDirToCur in extNamesByStems:
+        # Walked directory, look up instead of touching file system
+        extNames = extNamesByStems[relDirToCur].get(
+            path.basename(relSrcSplitedHeadToCur), set())
+
+        def exists(srcExtName: str) -> bool:
+            return srcExtName in extNames
+    else:
+        def exists(srcExtName: str) -> bool:
+            return path.exists(relSrcSplitedHeadToCur + srcExtName)
+    if extName in ext.headers:
+        for srcExtName in ext.sources:
+            if exists(srcExtName):
+                relSourcesToRoot.add(
+                    path.relpath(relSrcSplitedHeadToCur + srcExtName, relRootToCur))
+    if extName in ext.head_source_pairs.keys():
+        mappedExt = ext.head_source_pairs[extName]
+        if exists(mappedExt):
+            relSourcesToRoot.add(
+                path.relpath(relSrcSplitedHeadToCur + mappedExt, relRootToCur))
+    return relSourcesToRoot
+
+
+def __register(relSrcToRoot: str, info: dependency) -> None:
+    depsDict.update({relSrcToRoot: info})
+    if info.provide:
+        modulesBiDict.update({info.provide: relSrcToRoot})
+    if info.implement:
+        implDict.update({info.implement: relSrcToRoot})
+
+
+def __notify(relSrcToRoot: str, info: dependency, origin: str) -> None:
+    for listener in fileListeners:
+        listener(relSrcToRoot, info, origin)
+
+
+def __logMiss(event: str, relSrcToRoot: str, logUpdate: bool, details: dict[str, Any]) -> None:
+    '''
+    Files missed in cache are only logged one by one if asked, or if modified.
+    '''
+    if logUpdate or details:
+        logFile(event, relSrcToRoot, **details)
+    else:
+        logCounts[event] = logCounts.get(event, 0) + 1
+
+
+def cacheHitsAndMisses(counts: dict[str, int]) -> tuple[int, int]:
+    '''
+    Files found in cache or shared cache, and files scanned, from counts of events.
+    '''
+    hits = counts.get("unmodified", 0) + counts.get("shared", 0)
+    misses = counts.get("missed", 0) + counts.get("modified", 0)
+    return hits, misses
 
-def scanFileDependencies(relSrcToCur: str, relRootToCur: str,  verbosity: int, encoding: str, ext: extensionMapper, logUpdate: bool) -> None:
-    if "ast.ixx" in relSrcToCur:
-        pass
-    if not path.exists(relSrcToCur):
+
+def scanFileDependencies(relSrcToCur: str, relRootToCur: str,  verbosity: int, encoding: str, ext: extensionMapper, logUpdate: bool, prefetched: Optional[prefetchedFile] = None) -> None:
+    if prefetched is None:
+        prefetched = prefetchFile(relSrcToCur, relRootToCur)
+    if prefetched.mtime is None:
         raise Exception(
             f"Unexistent file \"{relSrcToCur}\" referenced.")
 
     relSrcToRoot = path.relpath(relSrcToCur, relRootToCur)
-    relLog = path.relpath(path.join(relRootToCur, LOG_PATH))
     skip = False
 
     info: dependency
+    # Misses are logged once shared cache is looked up
+    missed = "missed"
+    missDetails: dict[str, Any] = dict()
     if relSrcToRoot in depsDictCache:
         lastScanTime = depsDictCache[relSrcToRoot].time
-        lastModTime = path.getmtime(relSrcToCur)
+        lastModTime = prefetched.mtime
         if lastScanTime <= lastModTime:
             if verbosity >= VERBOSITY_MODIFIED_FILE:
                 print(
                     BLUE + f"Modification after last scan detected on file \"{relSrcToCur}\"" + RESET)
-            with open(relLog, 'a') as log:
-                print(
-                    f"{lastScanTime} < {lastModTime}, \"{relSrcToCur}\"",
-                    file=log
-                )
+            missed = "modified"
+            missDetails = dict(lastScan=lastScanTime,
+                               lastModification=lastModTime)
         else:
             if verbosity >= VERBOSITY_UNMODIFIED_FILE:
                 print(
                     BLUE + f"Scanned file \"{relSrcToCur}\", skipped" + RESET)
+            logCounts["unmodified"] = logCounts.get("unmodified", 0) + 1
             skip = True
-    elif logUpdate:
-        with open(relLog, 'a') as log:
-            print(
-                f"Missed, \"{relSrcToCur}\"",
-                file=log
-            )
     if skip:
-        depsDict.update({relSrcToRoot: depsDictCache[relSrcToRoot]})
-        info = depsDict[relSrcToRoot]
-        if info.provide:
-            modulesBiDict.update({info.provide: relSrcToRoot})
-        if info.implement:
-            implDict.update({info.implement: relSrcToRoot})
+        __register(relSrcToRoot, depsDictCache[relSrcToRoot])
+        __notify(relSrcToRoot, depsDictCache[relSrcToRoot], "cache")
         return
 
-    with open(relSrcToCur, encoding=encoding) as file:
-        if verbosity >= VERBOSITY_SCANNING_FILE:
-            print(BLUE + f"Scanning file \"{relSrcToCur}\"" + RESET)
+    digest: Optional[str] = None
+    if sharedDepsDict is not None:
+        digest = __sharedDigest(prefetched, encoding)
+        if digest in sharedDepsDict:
+            if verbosity >= VERBOSITY_UNMODIFIED_FILE:
+                print(
+                    BLUE + f"Scanned file \"{relSrcToCur}\" found in shared cache, skipped" + RESET)
+            __logMiss("shared", relSrcToRoot, logUpdate, missDetails)
+            info = __loadDependency(
+                {**sharedDepsDict[digest], "time": time.time(), "sources": {"sources": []}})
+            info.sources.sources = __pairSources(relSrcToCur, relRootToCur, ext)
+            __register(relSrcToRoot, info)
+            __notify(relSrcToRoot, info, "shared")
+            return
+
+    __logMiss(missed, relSrcToRoot, logUpdate, missDetails)
+    if verbosity >= VERBOSITY_SCANNING_FILE:
+        print(BLUE + f"Scanning file \"{relSrcToCur}\"" + RESET)
+    global content
+    if prefetched.data is None:
+        prefetched = prefetchFile(relSrcToCur, relRootToCur, True)
+    # Same newline translation as reading in text mode
+    content = " " + prefetched.data.decode(encoding).replace('\r\n', '\n').replace('\r', '\n')
+
+    def drop(next_index: int, desc: str):
         global content
-        content = " " + file.read()
-
-        def drop(next_index: int, desc: str):
-            global content
-            if verbosity >= VERBOSITY_DROPPING_FILE_CONTENT:
-                print(CYAN+desc+RESET)
-                print(content[:next_index])
-            content = content[next_index+1:]
-        info = dependency(time=time.time())
-
-        relSrcSplitedHeadToCur, extName = path.splitext(relSrcToCur)
-        if extName in ext.headers:
-            for srcExtName in ext.sources:
-                relSrcMappedSrcToCur = relSrcSplitedHeadToCur + srcExtName
-                if path.exists(relSrcMappedSrcToCur):
-                    info.sources.sources.add(
-                        path.relpath(relSrcMappedSrcToCur, relRootToCur))
-        if extName in ext.head_source_pairs.keys():
-            mappedExt = ext.head_source_pairs[extName]
-            relSrcMappedSrcToCur = relSrcSplitedHeadToCur + mappedExt
-            if path.exists(relSrcMappedSrcToCur):
-                info.sources.sources.add(
-                    path.relpath(relSrcMappedSrcToCur, relRootToCur))
-
-        while True:
-            # Optimizable
-            a, b, c, d, e, f, g, h = (content.find(s)
-                                      for s in ["#include", '"', "'", '//', '/*', 'import', 'export', 'module'])
-
-            if a == b == c == d == e == f == g == h == -1:
-                depsDict[relSrcToRoot] = info
-                if info.implement:
-                    implDict.setdefault(info.implement, relSrcToRoot)
-                if info.provide:
-                    modulesBiDict.update({info.provide: relSrcToRoot})
-                return
-
-            if a == __uniqueMin(a, b, c, d, e, f, g, h):  # include
-                content = content[a+len("#include"):]
-                content = content.lstrip()
-                lib = re.search(r"^<[^<>]*>", content)
-                loc = re.search(r'^"[^"]*"', content)
-                if lib:
-                    span = lib.span()
-                    _path = content[span[0]:span[1]]
-                    if verbosity >= VERBOSITY_INCLUDING_HEADER:
-                        print(BLUE + "Including library header "+_path + RESET)
-                    content = content[span[1]:]
-                    info.headers.library.add(_path[1:-1])
-                elif loc:
-                    span = loc.span()
-                    _path = content[span[0]:span[1]]
-                    if verbosity >= VERBOSITY_INCLUDING_HEADER:
-                        print(BLUE + "Including local header "+_path + RESET)
-                    content = content[span[1]:]
-                    info.headers.local.add(_path[1:-1])
-                else:
-                    raise Exception("What's being included?")
-            elif b == __uniqueMin(a, b, c, d, e, f, g, h):  # string
-                raw = content[b-1] == 'R'  # Check if is raw string literal
-                content = content[b+1:]
-                if raw:
-                    end = ')'+content[:content.find("(")]+'"'
-                else:
-                    end = '"'
-
-                while True:
-                    escape = content.find("\\")
-                    next_quote = content.find(end)
-                    assert next_quote != -1, "Quotes not matched."
-                    if raw or escape < 0 or escape > next_quote:
-                        break
-                    assert (
-                        linesep not in content[:escape + 1]
-                        or raw
-                    ), "Multiline string"
-                    drop(escape+1, "Dropping below in escaped string:")
+        if verbosity >= VERBOSITY_DROPPING_FILE_CONTENT:
+            print(CYAN+desc+RESET)
+            print(content[:next_index])
+        content = content[next_index+1:]
+    info = dependency(time=time.time())
+
+    info.sources.sources = __pairSources(relSrcToCur, relRootToCur, ext)
+
+    while True:
+        # Optimizable
+        a, b, c, d, e, f, g, h = (content.find(s)
+                                  for s in ["#include", '"', "'", '//', '/*', 'import', 'export', 'module'])
+
+        if a == b == c == d == e == f == g == h == -1:
+            if digest is not None:
+                __share(digest, info)
+            depsDict[relSrcToRoot] = info
+            if info.implement:
+                implDict.setdefault(info.implement, relSrcToRoot)
+            if info.provide:
+                modulesBiDict.update({info.provide: relSrcToRoot})
+            __notify(relSrcToRoot, info, "scanned")
+            return
+
+        if a == __uniqueMin(a, b, c, d, e, f, g, h):  # include
+            content = content[a+len("#include"):]
+            content = content.lstrip()
+            lib = re.search(r"^<[^<>]*>", content)
+            loc = re.search(r'^"[^"]*"', content)
+            if lib:
+                span = lib.span()
+                _path = content[span[0]:span[1]]
+                if verbosity >= VERBOSITY_INCLUDING_HEADER:
+                    print(BLUE + "Including library header "+_path + RESET)
+                content = content[span[1]:]
+                info.headers.library.add(_path[1:-1])
+            elif loc:
+                span = loc.span()
+                _path = content[span[0]:span[1]]
+                if verbosity >= VERBOSITY_INCLUDING_HEADER:
+                    print(BLUE + "Including local header "+_path + RESET)
+                content = content[span[1]:]
+                info.headers.local.add(_path[1:-1])
+            else:
+                raise Exception("What's being included?")
+        elif b == __uniqueMin(a, b, c, d, e, f, g, h):  # string
+            raw = content[b-1] == 'R'  # Check if is raw string literal
+            content = content[b+1:]
+            if raw:
+                end = ')'+content[:content.find("(")]+'"'
+            else:
+                end = '"'
+
+            while True:
+                escape = content.find("\\")
+                next_quote = content.find(end)
+                assert next_quote != -1, "Quotes not matched."
+                if raw or escape < 0 or escape > next_quote:
+                    break
                 assert (
-                    linesep not in content[:next_quote + 1]
+                    linesep not in content[:escape + 1]
                     or raw
                 ), "Multiline string"
-                drop(next_quote+1, "Dropping below in escaped string:")
-            elif c == __uniqueMin(a, b, c, d, e, f, g, h):  # character
-                content = content[c+1:]
-                while True:
-                    escape = content.find("\\")
-                    next_quote = content.find(r"'")
-                    assert next_quote != -1, "Quotes not matched."
-                    if escape == -1 or escape > next_quote:
-                        break
-                    drop(escape+1, "Dropping below in eacaped string:")
-
-                assert linesep not in content[:next_quote +
-                                              1], "Multiline character"
-                drop(next_quote, "Dropping below in character:")
-            elif d == __uniqueMin(a, b, c, d, e, f, g, h):  # comment //
-                content = content[d:]
-                endline = content.find('\n\r')
-                if endline == -1:
-                    endline = content.find('\r\n')
-                if endline == -1:
-                    endline = content.find('\n')
-                if endline == -1:
-                    endline = content.find('\r')
-                if endline == -1:
-                    drop(len(content)-1, "Drropping below in comment:")
-                else:
-                    drop(endline-1, "Dropping below in comment:")
-            elif e == __uniqueMin(a, b, c, d, e, f, g, h):  # comment /**/
-                content = content[e:]
-                end_note = content.find('*/')
-                drop(end_note+len('*/'), "Dropping below in multi-line comment:")
-            elif f == __uniqueMin(a, b, c, d, e, f, g, h):  # import
-                if f == 0 or (f > 0 and re.fullmatch(r'\w', content[f-1])):
-                    content = content[h+len("import")-1:]
-                    continue
-                content = content[f+len("import"):]
-                if re.fullmatch(r"\w", content[0]):
-                    continue
-                next = re.search(r"[^\s]", content)
-                assert next, "Unexpected termination."
-                content = content[next.span()[0]:]
-                import_begin = 0
-                # Does it possible to have a semicolon in the name of a imported header?
-                import_end = content.find(r';')
-                assert import_end != -1, "Unexpected termination after 'import'"
-                imported = content[import_begin:import_end]
-                imported = __removeSpace(imported)
-                if re.fullmatch(r"<[^<>]*>", imported):
-                    info.modules.library.add(imported)
-                elif re.fullmatch(r"\"[^\"]*\"", imported):
-                    info.modules.local.add(imported)
-                elif re.fullmatch(r"[\w.:]+", imported):
-                    if imported.startswith(":"):
-                        main: str | None = info.provide if info.provide else info.implement
-                        assert main, "Importing partition should be written after module declaration or implementation."
-                        if ":" in main:
-                            semicolon = main.rfind(":")
-                            main = main[:semicolon]
-                        parDict.setdefault(main, set())
-                        parDict[main].add(imported)
-                        info.modules.module.add(main+imported)
-                    else:
-                        info.modules.module.add(imported)
+                drop(escape+1, "Dropping below in escaped string:")
+            assert (
+                linesep not in content[:next_quote + 1]
+                or raw
+            ), "Multiline string"
+            drop(next_quote+1, "Dropping below in escaped string:")
+        elif c == __uniqueMin(a, b, c, d, e, f, g, h):  # character
+            content = content[c+1:]
+            while True:
+                escape = content.find("\\")
+                next_quote = content.find(r"'")
+                assert next_quote != -1, "Quotes not matched."
+                if escape == -1 or escape > next_quote:
+                    break
+                drop(escape+1, "Dropping below in eacaped string:")
+
+            assert linesep not in content[:next_quote +
+                                          1], "Multiline character"
+            drop(next_quote, "Dropping below in character:")
+        elif d == __uniqueMin(a, b, c, d, e, f, g, h):  # comment //
+            content = content[d:]
+            endline = content.find('\n\r')
+            if endline == -1:
+                endline = content.find('\r\n')
+            if endline == -1:
+                endline = content.find('\n')
+            if endline == -1:
+                endline = content.find('\r')
+            if endline == -1:
+                drop(len(content)-1, "Drropping below in comment:")
+            else:
+                drop(endline-1, "Dropping below in comment:")
+        elif e == __uniqueMin(a, b, c, d, e, f, g, h):  # comment /**/
+            content = content[e:]
+            end_note = content.find('*/')
+            drop(end_note+len('*/'), "Dropping below in multi-line comment:")
+        elif f == __uniqueMin(a, b, c, d, e, f, g, h):  # import
+            if f == 0 or (f > 0 and re.fullmatch(r'\w', content[f-1])):
+                content = content[h+len("import")-1:]
+                continue
+            content = content[f+len("import"):]
+            if re.fullmatch(r"\w", content[0]):
+                continue
+            next = re.search(r"[^\s]", content)
+            assert next, "Unexpected termination."
+            content = content[next.span()[0]:]
+            import_begin = 0
+            # Does it possible to have a semicolon in the name of a imported header?
+            import_end = content.find(r';')
+            assert import_end != -1, "Unexpected termination after 'import'"
+            imported = content[import_begin:import_end]
+            imported = __removeSpace(imported)
+            if re.fullmatch(r"<[^<>]*>", imported):
+                info.modules.library.add(imported)
+            elif re.fullmatch(r"\"[^\"]*\"", imported):
+                info.modules.local.add(imported)
+            elif re.fullmatch(r"[\w.:]+", imported):
+                if imported.startswith(":"):
+                    main: str | None = info.provide if info.provide else info.implement
+                    assert main, "Importing partition should be written after module declaration or implementation."
+                    if ":" in main:
+                        semicolon = main.rfind(":")
+                        main = main[:semicolon]
+                    parDict.setdefault(main, set())
+                    parDict[main].add(imported)
+                    info.modules.module.add(main+imported)
                 else:
-                    raise Exception("What's being imported?")
+                    info.modules.module.add(imported)
+            else:
+                raise Exception("What's being imported?")
 
-                content = content[import_end+1:]
-            elif g == __uniqueMin(a, b, c, d, e, f, g, h):  # export
-                if g == 0 or (g > 0 and re.fullmatch(r'\w', content[g-1])):
-                    content = content[h+len("export"):]
-                    continue
-                content = content[g+len("export"):]
-                if re.fullmatch(r"\w", content[0]):
-                    continue
-                next = re.search(r"[^\s]", content)
-                assert next, "Unexpected termination."
-                content = content[next.span()[0]:]
-                semicolon = None
-                if content.startswith("module"):
-                    assert not info.provide, "Exporting more than 1 modules"
-                    content = content.removeprefix("module")
-                    semicolon = content.find(";")
-                    info.provide = __removeSpace(content[:semicolon])
-                elif content.startswith("import"):
-                    assert info.provide, "Re-exporting should be written after exporting."
-                    content = content.removeprefix("import")
-                    semicolon = content.find(";")
-                    partition = __removeSpace(content[:semicolon])
-                    parDict.setdefault(info.provide, set())
-                    parDict[info.provide].add(partition)
-                    info.modules.module.add(info.provide+partition)
-                else:
-                    if verbosity >= VERBOSITY_EXPORTING:
-                        print(CYAN + "Exporting" + RESET)
-
-                if semicolon:
-                    content = content[semicolon+1:]
-            elif h == __uniqueMin(a, b, c, d, e, f, g, h):  # module
-                if h == 0 or (h > 0 and re.fullmatch(r'\w', content[h-1])):
-                    content = content[h+len("module")-1:]
-                    continue
-                content = content[h+len("module"):]
-                if re.fullmatch(r"\w", content[0]):
-                    continue
-                next = re.search(r"[^\s]", content)
-                assert next, "Unexpected termination."
-                content = content[next.span()[0]:]
+            content = content[import_end+1:]
+        elif g == __uniqueMin(a, b, c, d, e, f, g, h):  # export
+            if g == 0 or (g > 0 and re.fullmatch(r'\w', content[g-1])):
+                content = content[h+len("export"):]
+                continue
+            content = content[g+len("export"):]
+            if re.fullmatch(r"\w", content[0]):
+                continue
+            next = re.search(r"[^\s]", content)
+            assert next, "Unexpected termination."
+            content = content[next.span()[0]:]
+            semicolon = None
+            if content.startswith("module"):
+                assert not info.provide, "Exporting more than 1 modules"
+                content = content.removeprefix("module")
                 semicolon = content.find(";")
-                implement = __removeSpace(content[:semicolon])
-                if re.fullmatch(r"\s*", implement):
-                    continue
-                info.implement = implement
+                info.provide = __removeSpace(content[:semicolon])
+            elif content.startswith("import"):
+                assert info.provide, "Re-exporting should be written after exporting."
+                content = content.removeprefix("import")
+                semicolon = content.find(";")
+                partition = __removeSpace(content[:semicolon])
+                parDict.setdefault(info.provide, set())
+                parDict[info.provide].add(partition)
+                info.modules.module.add(info.provide+partition)
+            else:
+                if verbosity >= VERBOSITY_EXPORTING:
+                    print(CYAN + "Exporting" + RESET)
 
+            if semicolon:
                 content = content[semicolon+1:]
-            else:
-                raise Exception("What the fuck?")
+        elif h == __uniqueMin(a, b, c, d, e, f, g, h):  # module
+            if h == 0 or (h > 0 and re.fullmatch(r'\w', content[h-1])):
+                content = content[h+len("module")-1:]
+                continue
+            content = content[h+len("module"):]
+            if re.fullmatch(r"\w", content[0]):
+                continue
+            next = re.search(r"[^\s]", content)
+            assert next, "Unexpected termination."
+            content = content[next.span()[0]:]
+            semicolon = content.find(";")
+            implement = __removeSpace(content[:semicolon])
+            if re.fullmatch(r"\s*", implement):
+                continue
+            info.implement = implement
+
+            content = content[semicolon+1:]
+        else:
+            raise Exception("What the fuck?")
+
+
+def logFile(event: str, relFileToRoot: str, **details: Any) -> None:
+    logCounts[event] = logCounts.get(event, 0) + 1
+    logEntries.append(
+        dict(event=event, file=relFileToRoot, **details))
+
+
+def __rotateLog(relLogToCur: str, backups: int) -> None:
+    if backups <= 0:
+        os.remove(relLogToCur)
+        return
+    for i in range(backups - 1, 0, -1):
+        if path.exists(f"{relLogToCur}.{i}"):
+            os.replace(f"{relLogToCur}.{i}", f"{relLogToCur}.{i + 1}")
+    os.replace(relLogToCur, f"{relLogToCur}.1")
+
+
+def flushLog(relRootToCur: str, maxBytes: int, backups: int) -> None:
+    '''
+    Append buffered entries and a summary of this run to the log at once,
+    rotating it first if it would grow beyond maxBytes.
+    '''
+    global logEntries
+    relLogToCur = path.relpath(path.join(relRootToCur, LOG_PATH))
+    lines = [json.dumps(entry) + '\n' for entry in logEntries]
+    lines.append(json.dumps(
+        dict(event="summary", time=time.time(), **logCounts)) + '\n')
+    text = "".join(lines)
+    if maxBytes > 0 and path.exists(relLogToCur) and path.getsize(relLogToCur) + len(text) > maxBytes:
+        __rotateLog(relLogToCur, backups)
+    with open(relLogToCur, 'a') as log:
+        log.write(text)
+    logEntries = []
 
 
 CACHE_PATH = "umakeCache.json"
 
 
+@contextmanager
+def openAtomically(relFileToCur: str, mode: str = 'w', **kwargs: Any) -> Iterator[IO[Any]]:
+    '''
+    Write to a temporary file and then rename it,
+    so that the file is never seen half-written.
+    '''
+    relTempToCur = f"{relFileToCur}.{os.getpid()}.tmp"
+    try:
+        with open(relTempToCur, mode, **kwargs) as file:
+            yield file
+        os.replace(relTempToCur, relFileToCur)
+    finally:
+        if path.exists(relTempToCur):
+            os.remove(relTempToCur)
+
+
+def discardOutput(out: IO[Any]) -> None:
+    '''
+    Drop everything written to an output whose reader is gone,
+    so that flushing it again, even at exit, doesn't fail.
+    '''
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, out.fileno())
+    os.close(devnull)
+
+
+def __dumpCache(relRootToCur: str, deps: dict[str, dependency]):
+    with openAtomically(path.join(relRootToCur, CACHE_PATH)) as cache:
+        json.dump(deps, cache, cls=encoder)
+
+
 def saveCache(relRootToCur: str):
-    with open(path.join(relRootToCur, CACHE_PATH), 'w') as cache:
-        json.dump(depsDict, cache, cls=encoder)
+    __dumpCache(relRootToCur, {**retainedDepsDict, **depsDict})
+
+
+def savePartialCache(relRootToCur: str) -> dict[str, dependency]:
+    '''
+    Save both cached and scanned results except those of dirty files,
+    which will be scanned again next time. Saved results are returned.
+    '''
+    deps = {
+        relFileToRoot: dep
+        for relFileToRoot, dep in {**retainedDepsDict, **depsDictCache, **depsDict}.items()
+        if relFileToRoot not in dirtyFiles
+    }
+    __dumpCache(relRootToCur, deps)
+    relCacheToCur = path.relpath(path.join(relRootToCur, CACHE_PATH))
+    for relFileToRoot in sorted(dirtyFiles):
+        if relFileToRoot in removedDependencies:
+            relDependentToRoot = removedDependencies[relFileToRoot]
+            if relDependentToRoot is None:
+                print(YELLOW+f"Dependency \"{relFileToRoot}\" removed." +
+                      RESET, file=stderr)
+            else:
+                print(YELLOW+f"Dependency \"{relFileToRoot}\" removed, cached result of \"{relDependentToRoot}\" invalidated." +
+                      RESET, file=stderr)
+        elif relFileToRoot not in removedDependencies.values():
+            print(YELLOW+f"Cached result of \"{relFileToRoot}\" invalidated." +
+                  RESET, file=stderr)
+    print(YELLOW+f"Cache at \"{relCacheToCur}\" saved with {len(deps)} entries." +
+          RESET, file=stderr)
+    return deps
+
+
+SHARD_CACHE_PATH = "umakeCache.shard-{}-of-{}.json"
+SHARD_CACHE_PATTERN = r"umakeCache\.shard-(\d+)-of-(\d+)\.json"
+
+
+def saveCacheFragment(relRootToCur: str, shard: tuple[int, int], verbosity: int):
+    '''
+    Save files scanned in this shard, to be combined by mergeCacheFragments.
+    '''
+    relFragmentToCur = path.relpath(
+        path.join(relRootToCur, SHARD_CACHE_PATH.format(*shard)))
+    with openAtomically(relFragmentToCur) as fragment:
+        json.dump(dict(shard=list(shard), dependencies=depsDict),
+                  fragment, cls=encoder)
+    if verbosity >= VERBOSITY_SCANNING_STATISTICS:
+        print(CYAN + f"Fragment at \"{relFragmentToCur}\" saved with {len(depsDict)} entries." + RESET)
+
+
+def mergeCacheFragments(relRootToCur: str, relFragmentsToCur: list[str], verbosity: int):
+    '''
+    Combine fragments of all shards as if files were scanned in one run.
+    Fragments on root are combined if none is given.
+    '''
+    if not relFragmentsToCur:
+        relFragmentsToCur = [
+            path.relpath(path.join(relRootToCur, file))
+            for file in sorted(os.listdir(relRootToCur))
+            if re.fullmatch(SHARD_CACHE_PATTERN, file)
+        ]
+    assert relFragmentsToCur, f"No cache fragment found on \"{relRootToCur}\", scan with --shard first."
+
+    count: Optional[int] = None
+    fragmentsByIndices: dict[int, str] = dict()
+    # Module name --> (file, fragment)
+    providers: dict[str, tuple[str, str]] = dict()
+    collisions: list[str] = []
+    for relFragmentToCur in relFragmentsToCur:
+        with open(relFragmentToCur) as fragment:
+            s: dict[str, Any] = json.load(fragment)
+        index, fragmentCount = s["shard"]
+        assert count is None or count == fragmentCount, f"Fragment \"{relFragmentToCur}\" is from {fragmentCount} shards, but others are from {count} shards."
+        count = fragmentCount
+        assert index not in fragmentsByIndices, f"Both \"{fragmentsByIndices[index]}\" and \"{relFragmentToCur}\" are fragments of shard {index}/{count}."
+        fragmentsByIndices[index] = relFragmentToCur
+        for relFileToRoot, dep in sorted(s["dependencies"].items()):
+            info = __loadDependency(dep)
+            if info.provide is not None:
+                if info.provide in providers and providers[info.provide][0] != relFileToRoot:
+                    relOtherToRoot, relOtherFragmentToCur = providers[info.provide]
+                    collisions.append(
+                        f"Module \"{info.provide}\" is provided by both \"{relOtherToRoot}\" (in \"{relOtherFragmentToCur}\") and \"{relFileToRoot}\" (in \"{relFragmentToCur}\").")
+                    continue
+                providers[info.provide] = (relFileToRoot, relFragmentToCur)
+            __register(relFileToRoot, info)
+            __notify(relFileToRoot, info, "merged")
+    assert count is not None
+    missing = sorted(set(range(count)) - fragmentsByIndices.keys())
+    assert not missing, f"Fragments of shards {', '.join(f'{index}/{count}' for index in missing)} are missing."
+    for collision in collisions:
+        print(RED + collision + RESET, file=stderr)
+    if collisions:
+        raise Exception(
+            f"{len(collisions)} module names are provided by several files.")
+    if verbosity >= VERBOSITY_SCANNING_STATISTICS:
+        print(CYAN + f"Merged {len(depsDict)} entries from {count} fragments." + RESET)
 
 
 def deleteCache(relRootToCur: str):
+    relIndexToCur = path.relpath(path.join(relRootToCur, REVERSE_INDEX_PATH))
+    if path.exists(relIndexToCur):
+        os.remove(relIndexToCur)
     relCacheToCur = path.relpath(path.join(relRootToCur, CACHE_PATH))
     if path.exists(relCacheToCur):
         os.remove(relCacheToCur)
@@ -530,6 +917,37 @@ def deleteCache(relRootToCur: str):
         print(YELLOW+"Cache not found."+RESET, file=stderr)
 
 
+def __strings(value: Any) -> set[str]:
+    assert isinstance(value, list) and all(
+        isinstance(item, str) for item in value), f"{value} is not a list of strings."
+    return set(value)
+
+
+def __loadDependency(dep: Any) -> dependency:
+    assert isinstance(dep, dict), f"{dep} is not an object."
+    headers: dict[str, list[str]] = dep["headers"]
+    modules: dict[str, list[str]] = dep["modules"]
+    sources: dict[str, list[str]] = dep["sources"]
+    assert isinstance(dep["time"], (int, float)), "Scanning time is not a number."
+    for key in ["provide", "implement"]:
+        assert dep[key] is None or isinstance(
+            dep[key], str), f"\"{key}\" is not a string."
+    return dependency(
+        dep["time"],
+        headersDependency(
+            __strings(headers["library"]), __strings(headers["local"])
+        ),
+        modulesDependency(
+            __strings(modules["module"]),
+            __strings(modules["library"]),
+            __strings(modules["local"])
+        ),
+        dep["provide"],
+        dep["implement"],
+        sourcesDependency(__strings(sources["sources"]))
+    )
+
+
 def loadCache(relRootToCur: str):
     relCacheToCur = path.relpath(path.join(relRootToCur, CACHE_PATH))
     if path.exists(relCacheToCur):
@@ -541,29 +959,360 @@ def loadCache(relRootToCur: str):
                               # Union[str, dict[str, list[str]]]
                               ]
                 ] = json.load(cache)
-                for source, dep in s.items():
-                    headers: dict[str, list[str]] = dep["headers"]
-                    modules: dict[str, list[str]] = dep["modules"]
-                    sources: dict[str, list[str]] = dep["sources"]
-                    depsDictCache.update({source: dependency(
-                        dep["time"],
-                        headersDependency(
-                            set(headers["library"]), set(headers["local"])
-                        ),
-                        modulesDependency(
-                            set(modules["module"]),
-                            set(modules["library"]),
-                            set(modules["local"])
-                        ),
-                        dep["provide"],
-                        dep["implement"],
-                        sourcesDependency(set(sources["sources"]))
-                    )})
+            assert isinstance(s, dict), "Cache is not an object."
         except Exception as e:
             print("Original cache is not correct for reason below. Deleting.")
             print(e)
             os.remove(relCacheToCur)
+            return
+        for source, dep in s.items():
+            try:
+                depsDictCache.update({source: __loadDependency(dep)})
+            except Exception as e:
+                # Quarantine the entry, so that only this file is scanned again
+                # as it is absent from the cache
+                print(
+                    f"Cached result of \"{source}\" is not correct for reason below. Ignored.")
+                print(repr(e))
+                logFile("quarantined", source, reason=repr(e))
+
+
+SHARED_CACHE_PATH = "umakeSharedCache.json"
+SHARED_CACHE_LOCK_PATH = SHARED_CACHE_PATH + ".lock"
 
+try:
+    import fcntl
 
-def cleanCache():
-    depsDictCache = None
+    def __lock(lock: IO[Any], exclusive: bool):
+        fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+    def __unlock(lock: IO[Any]):
+        fcntl.flock(lock, fcntl.LOCK_UN)
+except ImportError:
+    import msvcrt
+
+    # No shared lock on Windows
+    def __lock(lock: IO[Any], exclusive: bool):
+        lock.seek(0)
+        msvcrt.locking(lock.fileno(), msvcrt.LK_LOCK, 1)
+
+    def __unlock(lock: IO[Any]):
+        lock.seek(0)
+        msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def __lockedSharedCache(cacheDir: str, exclusive: bool):
+    with open(path.join(cacheDir, SHARED_CACHE_LOCK_PATH), 'a') as lock:
+        __lock(lock, exclusive)
+        try:
+            yield
+        finally:
+            __unlock(lock)
+
+
+def __readSharedCache(cacheDir: str) -> tuple[dict[str, dict[str, Any]], dict[str, tuple[float, str]]]:
+    relSharedToCur = path.join(cacheDir, SHARED_CACHE_PATH)
+    if not path.exists(relSharedToCur):
+        return dict(), dict()
+    try:
+        with open(relSharedToCur) as cache:
+            s: dict[str, Any] = json.load(cache)
+        deps: dict[str, dict[str, Any]] = s["dependencies"]
+        paths: dict[str, tuple[float, str]] = {
+            absFile: (recorded[0], recorded[1]) for absFile, recorded in s["paths"].items()
+        }
+    except Exception as e:
+        print("Shared cache is not correct for reason below. Ignored.")
+        print(repr(e))
+        return dict(), dict()
+    for digest, dep in list(deps.items()):
+        try:
+            __loadDependency(
+                {**dep, "time": time.time(), "sources": {"sources": []}})
+        except Exception:
+            del deps[digest]
+    return deps, paths
+
+
+def __sharedDigest(prefetched: prefetchedFile, encoding: str) -> str:
+    '''
+    Hash of file content, which is looked up by absolute path and modification time first.
+    '''
+    absFile = path.abspath(prefetched.relFileToCur)
+    assert prefetched.mtime is not None
+    recorded = sharedPathsDict.get(absFile)
+    if recorded is not None and recorded[0] == prefetched.mtime:
+        return recorded[1]
+    data = prefetched.data
+    if data is None:
+        with open(prefetched.relFileToCur, 'rb') as file:
+            data = file.read()
+    digest = hashlib.sha256(
+        encoding.encode() + b'\0' + data).hexdigest()
+    sharedPathsDict[absFile] = (prefetched.mtime, digest)
+    sharedPathsPending[absFile] = (prefetched.mtime, digest)
+    return digest
+
+
+def __share(digest: str, info: dependency) -> None:
+    dep: dict[str, Any] = json.loads(json.dumps(info, cls=encoder))
+    del dep["time"]
+    del dep["sources"]
+    assert sharedDepsDict is not None
+    sharedDepsDict[digest] = dep
+    sharedDepsPending[digest] = dep
+
+
+def loadSharedCache(cacheDir: str):
+    global sharedDepsDict, sharedPathsDict
+    os.makedirs(cacheDir, exist_ok=True)
+    with __lockedSharedCache(cacheDir, False):
+        sharedDepsDict, sharedPathsDict = __readSharedCache(cacheDir)
+
+
+def saveSharedCache(cacheDir: str):
+    '''
+    Merge entries added in this run into shared cache,
+    which may have been updated by other processes since loaded.
+    '''
+    global sharedDepsPending, sharedPathsPending
+    if not sharedDepsPending and not sharedPathsPending:
+        return
+    with __lockedSharedCache(cacheDir, True):
+        deps, paths = __readSharedCache(cacheDir)
+        deps.update(sharedDepsPending)
+        paths.update(sharedPathsPending)
+        with openAtomically(path.join(cacheDir, SHARED_CACHE_PATH)) as cache:
+            json.dump(dict(dependencies=deps, paths=paths), cache)
+    sharedDepsPending = dict()
+    sharedPathsPending = dict()
+
+
+def dependedFiles(relFileToRoot: str, dep: dependency, modules: dict[str, str]) -> set[str]:
+    '''
+    Files included or imported by a file directly, relative to root.
+    Sources paired with included headers are not counted.
+    '''
+    relDirToRoot = path.dirname(relFileToRoot)
+    depended: set[str] = set()
+    for relIncludedToSrc in dep.headers.local:
+        depended.add(path.normpath(
+            path.join(relDirToRoot, relIncludedToSrc)))
+    for imported in dep.modules.local:
+        depended.add(resolveHeaderUnit(relDirToRoot, imported))
+    for imported in dep.modules.module:
+        if imported in modules:
+            depended.add(modules[imported])
+    if dep.implement and dep.implement in modules:
+        depended.add(modules[dep.implement])
+    return depended
+
+
+REVERSE_INDEX_PATH = "umakeReverseIndex.json"
+REVERSE_INDEX_VERSION = 3
+
+
+def saveReverseIndex(relRootToCur: str, objects: dict[str, str], targets: dict[str, str], deps: Optional[dict[str, dependency]] = None):
+    '''
+    Save files depending on every file, so that files affected by changes can be found without scanning.
+    Sources paired with included headers are saved separately in links,
+    as changing them only makes their dependents relinked.
+    Objects and targets are saved by names, as a source may be built under several roots in batch.
+    '''
+    if deps is None:
+        deps = depsDict
+    modules = {dep.provide: relFileToRoot for relFileToRoot,
+               dep in deps.items() if dep.provide}
+    reverse: dict[str, set[str]] = dict()
+    links: dict[str, set[str]] = dict()
+    for relFileToRoot, dep in deps.items():
+        for relDependedToRoot in dependedFiles(relFileToRoot, dep, modules):
+            if relDependedToRoot != relFileToRoot:
+                reverse.setdefault(relDependedToRoot, set()).add(relFileToRoot)
+        for relSourceToRoot in dep.sources.sources:
+            if relSourceToRoot != relFileToRoot:
+                links.setdefault(relSourceToRoot, set()).add(relFileToRoot)
+    with openAtomically(path.join(relRootToCur, REVERSE_INDEX_PATH)) as index:
+        json.dump(dict(
+            version=REVERSE_INDEX_VERSION,
+            reverse=reverse,
+            links=links,
+            modules=modules,
+            objects=dict(objects),
+            targets=dict(targets),
+        ), index, cls=encoder)
+
+
+def loadReverseIndex(relRootToCur: str) -> dict[str, Any]:
+    relIndexToCur = path.relpath(path.join(relRootToCur, REVERSE_INDEX_PATH))
+    assert path.exists(
+        relIndexToCur), f"Reverse dependency index \"{relIndexToCur}\" not found, run umake once first."
+    with open(relIndexToCur) as index:
+        s: dict[str, Any] = json.load(index)
+    assert s.get("version") == REVERSE_INDEX_VERSION, f"Reverse dependency index \"{relIndexToCur}\" is outdated, run umake once first."
+    return s
+
+
+def __dependents(reverse: dict[str, list[str]], relFilesToRoot: Iterable[str]) -> set[str]:
+    '''
+    Files depending on given files directly or indirectly, including themselves.
+    '''
+    dependents = set(relFilesToRoot)
+    worklist = list(dependents)
+    while worklist:
+        for relDependentToRoot in reverse.get(worklist.pop(), []):
+            if relDependentToRoot not in dependents:
+                dependents.add(relDependentToRoot)
+                worklist.append(relDependentToRoot)
+    return dependents
+
+
+def collectAffected(index: dict[str, Any], relChangedToRoot: set[str]) -> tuple[set[str], set[str]]:
+    '''
+    Files to be compiled again as they depend on changed files, including themselves,
+    and files only to be relinked as they link sources compiled again.
+    '''
+    reverse: dict[str, list[str]] = index["reverse"]
+    links: dict[str, list[str]] = index["links"]
+    affected = __dependents(reverse, relChangedToRoot)
+    relinked: set[str] = set()
+    # Linking is transitive, while compiling stays untouched
+    worklist = list(affected)
+    while worklist:
+        linking = __dependents(reverse, links.get(worklist.pop(), []))
+        for relLinkingToRoot in linking - affected - relinked:
+            relinked.add(relLinkingToRoot)
+            worklist.append(relLinkingToRoot)
+    return affected, relinked
+
+
+def __walked(relFileToCur: str) -> bool:
+    '''
+    Whether the file is in a folder walked in this run.
+    '''
+    relDirToCur = path.dirname(relFileToCur) or path.curdir
+    while True:
+        if relDirToCur in extNamesByStems:
+            return True
+        relParentToCur = path.dirname(relDirToCur)
+        if not relParentToCur or relParentToCur == relDirToCur:
+            return False
+        relDirToCur = relParentToCur
+
+
+def cleanCache(relRootToCur: str, verbosity: int, shard: Optional[tuple[int, int]] = None):
+    '''
+    Release cache loaded from file after scanning.
+    Entries of files outside walked folders or other shards are retained,
+    while entries of other files not found in this run are evicted.
+    '''
+    for relFileToRoot, dep in depsDictCache.items():
+        if relFileToRoot in depsDict:
+            continue
+        inOtherShard = shard is not None and not inShard(relFileToRoot, shard)
+        if not inOtherShard and __walked(path.relpath(path.join(relRootToCur, relFileToRoot))):
+            logFile("evicted", relFileToRoot)
+        else:
+            retainedDepsDict[relFileToRoot] = dep
+            logCounts["retained"] = logCounts.get("retained", 0) + 1
+    depsDictCache.clear()
+    if verbosity >= VERBOSITY_SCANNING_STATISTICS:
+        hits, misses = cacheHitsAndMisses(logCounts)
+        print(CYAN + f"Cache: {hits} hits, {misses} misses, {logCounts.get('evicted', 0)} evicted, {logCounts.get('retained', 0)} retained." + RESET)
+
+
+def __cachedFile(relRootToCur: str, relFileToRoot: str, dep: dependency) -> str:
+    '''
+    State of a cached file: "up-to-date", "modified" or "missing".
+    '''
+    relFileToCur = path.join(relRootToCur, relFileToRoot)
+    if not path.exists(relFileToCur):
+        return "missing"
+    if dep.time <= path.getmtime(relFileToCur):
+        return "modified"
+    return "up-to-date"
+
+
+def printCacheStats(relRootToCur: str):
+    relCacheToCur = path.relpath(path.join(relRootToCur, CACHE_PATH))
+    assert path.exists(relCacheToCur), f"Cache \"{relCacheToCur}\" not found."
+    loadCache(relRootToCur)
+    states: dict[str, int] = dict()
+    for relFileToRoot, dep in depsDictCache.items():
+        state = __cachedFile(relRootToCur, relFileToRoot, dep)
+        states[state] = states.get(state, 0) + 1
+    print(f"Cache at \"{relCacheToCur}\": {path.getsize(relCacheToCur)} bytes, {len(depsDictCache)} entries.")
+    print(f"Modules: {sum(1 for dep in depsDictCache.values() if dep.provide)}, implement units: {sum(1 for dep in depsDictCache.values() if dep.implement)}.")
+    for state in ["up-to-date", "modified", "missing"]:
+        print(f"{state.capitalize()}: {states.get(state, 0)}.")
+    if logCounts.get("quarantined"):
+        print(f"Invalid: {logCounts['quarantined']}.")
+    relLogToCur = path.relpath(path.join(relRootToCur, LOG_PATH))
+    if path.exists(relLogToCur):
+        with open(relLogToCur) as log:
+            summaries = [line for line in log if '"summary"' in line]
+        if summaries:
+            summary: dict[str, Any] = json.loads(summaries[-1])
+            del summary["event"]
+            del summary["time"]
+            hits, misses = cacheHitsAndMisses(summary)
+            print(f"Last run: {hits} hits, {misses} misses, " + ", ".join(f"{count} {event}" for event, count in sorted(summary.items())) + ".")
+
+
+def collectCacheGarbage(relRootToCur: str, verbosity: int):
+    '''
+    Evict entries of missing files and invalid entries.
+    '''
+    loadCache(relRootToCur)
+    deps: dict[str, dependency] = dict()
+    for relFileToRoot, dep in depsDictCache.items():
+        if __cachedFile(relRootToCur, relFileToRoot, dep) == "missing":
+            if verbosity >= VERBOSITY_MODIFIED_FILE:
+                print(YELLOW + f"Evicting missing file \"{relFileToRoot}\"." + RESET)
+            logFile("evicted", relFileToRoot)
+        else:
+            deps[relFileToRoot] = dep
+    depsDictCache.clear()
+    __dumpCache(relRootToCur, deps)
+    print(f"Evicted {logCounts.get('evicted', 0)} entries and {logCounts.get('quarantined', 0)} invalid entries, {len(deps)} entries kept.")
+
+
+def __canonical(value: Any) -> Any:
+    if isinstance(value, (set, list)):
+        return sorted(__canonical(item) for item in value)
+    if hasattr(value, '__dict__'):
+        return {key: __canonical(item) for key, item in vars(value).items()}
+    return value
+
+
+def verifyCache(relRootToCur: str, encoding: str, ext: extensionMapper, verbosity: int) -> bool:
+    '''
+    Scan files with up-to-date entries again, and compare results with cache.
+    '''
+    loadCache(relRootToCur)
+    cached = dict(depsDictCache)
+    # Cache is not looked up when scanning
+    depsDictCache.clear()
+    mismatched = 0
+    for relFileToRoot, dep in sorted(cached.items()):
+        state = __cachedFile(relRootToCur, relFileToRoot, dep)
+        if state != "up-to-date":
+            if verbosity >= VERBOSITY_MODIFIED_FILE:
+                print(BLUE + f"Skipped {state} file \"{relFileToRoot}\"." + RESET)
+            continue
+        relFileToCur = path.relpath(path.join(relRootToCur, relFileToRoot))
+        try:
+            scanFileDependencies(relFileToCur, relRootToCur, 0, encoding, ext, False)
+            scanned = depsDict[relFileToRoot]
+            different = [
+                key for key in ["headers", "modules", "provide", "implement", "sources"]
+                if __canonical(vars(dep)[key]) != __canonical(vars(scanned)[key])
+            ]
+        except Exception as e:
+            different = [repr(e)]
+        if different:
+            mismatched += 1
+            print(RED + f"Cached result of \"{relFileToRoot}\" differs in {', '.join(different)}." + RESET, file=stderr)
+    print(f"Verified {len(cached)} entries, {mismatched} mismatched.")
+    return mismatched == 0
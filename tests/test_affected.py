@@ -0,0 +1,61 @@
+# Finding units affected by changed files with --affected-by, from the reverse index
+import json
+import os.path as path
+import subprocess
+import sys
+import pytest
+
+REPO = path.dirname(path.dirname(path.abspath(__file__)))
+
+
+def umake(root: str, *args: str) -> list[str]:
+    return subprocess.run(
+        [sys.executable, path.join(REPO, "umake.py"), "--root", ".", *args],
+        cwd=root,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.splitlines()
+
+
+@pytest.fixture
+def tree(tmp_path) -> str:
+    for folder in ["app", "lib", "shared"]:
+        (tmp_path / folder).mkdir()
+    (tmp_path / "shared" / "util.hpp").write_text("int util();\n")
+    (tmp_path / "shared" / "util.cpp").write_text(
+        '#include "util.hpp"\nint util() { return 0; }\n'
+    )
+    (tmp_path / "app" / "main.cpp").write_text(
+        '#include "../shared/util.hpp"\nint main() { return util(); }\n'
+    )
+    (tmp_path / "lib" / "lib.cpp").write_text(
+        '#include "../shared/util.hpp"\nint lib() { return util(); }\n'
+    )
+    (tmp_path / "batch.json").write_text(
+        json.dumps(
+            [
+                dict(
+                    root="app", sources=["main", "main.cpp"], folders=[".", "../shared"]
+                ),
+                dict(
+                    root="lib", sources=["lib", "lib.cpp"], folders=[".", "../shared"]
+                ),
+            ]
+        )
+    )
+    return str(tmp_path)
+
+
+def test_batch(tree: str):
+    umake(tree, "--batch", "batch.json", "--target", "cmake")
+    # Objects of the shared source are built under both roots
+    assert umake(tree, "--affected-by", "shared/util.cpp") == [
+        "OBJECT app/..__shared__util.cpp SOURCE shared/util.cpp",
+        "OBJECT lib/..__shared__util.cpp SOURCE shared/util.cpp",
+        "TARGET app/main SOURCE app/main.cpp RELINK",
+        "TARGET lib/lib SOURCE lib/lib.cpp RELINK",
+    ]
+    assert umake(tree, "--affected-by", "app/main.cpp") == [
+        "TARGET app/main SOURCE app/main.cpp"
+    ]
@@ -0,0 +1,198 @@
+# Caching compilations with bmicache.py in front of a fake compiler
+import os
+import os.path as path
+import shutil
+import sys
+import pytest
+
+REPO = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, REPO)
+import bmicache
+
+# Concatenates the source and headers it includes into the output, and logs every run
+FAKE_COMPILER = f"""#!{sys.executable}
+import os.path as path
+import os
+import sys
+
+args = sys.argv[1:]
+source = args[args.index("-c") + 1]
+output = args[args.index("-o") + 1]
+with open(os.environ["FAKE_COMPILER_LOG"], "a") as log:
+    log.write(source + "\\n")
+with open(source) as file:
+    data = file.read()
+headers = [
+    path.join(path.dirname(source), line[len('#include "') : -1])
+    for line in data.splitlines()
+    if line.startswith('#include "')
+]
+with open(output, "w") as file:
+    file.write(data)
+    for header in headers:
+        with open(header) as included:
+            file.write(included.read())
+if "-MF" in args:
+    with open(args[args.index("-MF") + 1], "w") as depfile:
+        depfile.write(output + ": " + " ".join([source] + headers) + "\\n")
+print("compiled " + source)
+"""
+
+
+class fakeBuild:
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.cacheDir = path.join(root, "cache")
+        self.log = path.join(root, "log.txt")
+        bin = path.join(root, "bin")
+        os.makedirs(bin)
+        self.compiler = path.join(bin, "fake-c++")
+        with open(self.compiler, "w") as compiler:
+            compiler.write(FAKE_COMPILER)
+        os.chmod(self.compiler, 0o755)
+
+    def write(self, relFileToRoot: str, data: str) -> str:
+        file = path.join(self.root, relFileToRoot)
+        os.makedirs(path.dirname(file), exist_ok=True)
+        with open(file, "w") as out:
+            out.write(data)
+        return file
+
+    def read(self, relFileToRoot: str) -> str:
+        with open(path.join(self.root, relFileToRoot)) as file:
+            return file.read()
+
+    def compile(
+        self,
+        source: str,
+        output: str,
+        flags: list[str] = [],
+        references: list[str] = [],
+        compiler: str = "",
+        maxSize: int = bmicache.MAX_SIZE,
+    ) -> int:
+        launcher = ["--cache-dir", self.cacheDir, "--max-size", str(maxSize)]
+        for reference in references:
+            launcher += ["--reference", reference]
+        # Compilers don't make directories of outputs, which build systems do
+        os.makedirs(path.dirname(path.join(self.root, output)), exist_ok=True)
+        return bmicache.main(
+            launcher
+            + ["--", compiler or self.compiler]
+            + flags
+            + ["-o", path.join(self.root, output), "-c", path.join(self.root, source)]
+        )
+
+    def runs(self) -> int:
+        if not path.exists(self.log):
+            return 0
+        with open(self.log) as log:
+            return len(log.readlines())
+
+    def entries(self) -> list[str]:
+        entriesDir = path.join(self.cacheDir, "entries")
+        if not path.isdir(entriesDir):
+            return []
+        return [path.join(entriesDir, entry) for entry in os.listdir(entriesDir)]
+
+
+@pytest.fixture
+def build(tmp_path, monkeypatch) -> fakeBuild:
+    build = fakeBuild(str(tmp_path))
+    monkeypatch.setenv("FAKE_COMPILER_LOG", build.log)
+    return build
+
+
+def test_miss_then_hit(build: fakeBuild, capsys):
+    build.write("a.ixx", "export module a;\n")
+    assert build.compile("a.ixx", "a.o") == 0
+    assert build.runs() == 1
+    assert len(build.entries()) == 1
+    os.remove(path.join(build.root, "a.o"))
+
+    assert build.compile("a.ixx", "a.o") == 0
+    assert build.runs() == 1
+    assert build.read("a.o") == "export module a;\n"
+    # Messages of the compiler are replayed
+    assert capsys.readouterr().out.count("compiled") == 2
+
+
+def test_output_paths_ignored(build: fakeBuild):
+    build.write("a.ixx", "export module a;\n")
+    build.compile("a.ixx", "one/a.o")
+    build.compile("a.ixx", "two/a.o")
+    assert build.runs() == 1
+    assert build.read("two/a.o") == "export module a;\n"
+
+
+def test_changed_reference(build: fakeBuild):
+    build.write("b.ixx", "export module b;\nimport a;\n")
+    reference = build.write("one/a.pcm", "a, first")
+    flags = [f"-fmodule-file=a={reference}"]
+    build.compile("b.ixx", "one/b.o", flags, [reference])
+    build.write("one/a.pcm", "a, second")
+    build.compile("b.ixx", "one/b.o", flags, [reference])
+    assert build.runs() == 2
+
+
+def test_reference_in_another_build_tree(build: fakeBuild):
+    build.write("b.ixx", "export module b;\nimport a;\n")
+    for tree in ["one", "two"]:
+        reference = build.write(f"{tree}/a.pcm", "a")
+        build.compile(
+            "b.ixx",
+            f"{tree}/b.o",
+            [
+                f"-fprebuilt-module-path={path.join(build.root, tree)}",
+                f"-fmodule-file=a={reference}",
+            ],
+            [reference],
+        )
+    assert build.runs() == 1
+
+
+def test_depfile_manifest(build: fakeBuild):
+    build.write("a.ixx", 'export module a;\n#include "a.h"\n')
+    build.write("a.h", "first\n")
+    build.compile("a.ixx", "a.o")
+    build.compile("a.ixx", "a.o")
+    assert build.runs() == 1
+
+    build.write("a.h", "second\n")
+    build.compile("a.ixx", "a.o")
+    assert build.runs() == 2
+    assert build.read("a.o").endswith("second\n")
+
+    # Every combination of headers is kept
+    build.write("a.h", "first\n")
+    build.compile("a.ixx", "a.o")
+    assert build.runs() == 2
+    assert build.read("a.o").endswith("first\n")
+
+
+def test_lru_eviction(build: fakeBuild):
+    build.write("a.ixx", "a" * 1000)
+    build.write("b.ixx", "b" * 1000)
+    maxSize = 1500
+    build.compile("a.ixx", "a.o", maxSize=maxSize)
+    (first,) = build.entries()
+    # Used long before
+    os.utime(path.join(first, "meta.json"), (0, 0))
+    build.compile("b.ixx", "b.o", maxSize=maxSize)
+    assert not path.exists(first)
+    assert len(build.entries()) == 1
+
+    build.compile("b.ixx", "b.o", maxSize=maxSize)
+    assert build.runs() == 2
+    build.compile("a.ixx", "a.o", maxSize=maxSize)
+    assert build.runs() == 3
+
+
+def test_msvc_bypassed(build: fakeBuild):
+    cl = path.join(build.root, "bin", "cl")
+    shutil.copy(build.compiler, cl)
+    build.write("a.ixx", "export module a;\n")
+    build.compile("a.ixx", "a.obj", compiler=cl)
+    build.compile("a.ixx", "a.obj", compiler=cl)
+    assert build.runs() == 2
+    assert build.entries() == []
@@ -0,0 +1,54 @@
+# Inspecting and maintaining the cache kept between runs
+import os.path as path
+import subprocess
+import sys
+import pytest
+
+REPO = path.dirname(path.dirname(path.abspath(__file__)))
+
+
+def umake(root: str, *args: str) -> str:
+    return subprocess.run(
+        [sys.executable, path.join(REPO, "umake.py"), "--root", ".", *args],
+        cwd=root,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+
+
+def build(root: str) -> str:
+    return umake(root, "--target", "cmake", "main", "main.cpp")
+
+
+def lastRun(root: str) -> str:
+    (line,) = [
+        line
+        for line in umake(root, "--cache", "stats").splitlines()
+        if line.startswith("Last run:")
+    ]
+    return line
+
+
+@pytest.fixture
+def tree(tmp_path) -> str:
+    (tmp_path / "main.cpp").write_text(
+        '#include "a.h"\n#include "b.h"\nint main() { return 0; }\n'
+    )
+    (tmp_path / "a.h").write_text("int a();\n")
+    (tmp_path / "b.h").write_text("int b();\n")
+    return str(tmp_path)
+
+
+def test_stats_last_run(tree: str):
+    build(tree)
+    assert lastRun(tree) == "Last run: 0 hits, 3 misses, 3 missed."
+
+    # Runs with nothing changed are summarized as well
+    build(tree)
+    assert lastRun(tree) == "Last run: 3 hits, 0 misses, 3 unmodified."
+
+    with open(path.join(tree, "a.h"), "w") as header:
+        header.write("int a(int);\n")
+    build(tree)
+    assert lastRun(tree) == "Last run: 2 hits, 1 misses, 1 modified, 2 unmodified."
@@ -0,0 +1,127 @@
+# Reconfiguring with umake.cmake, which skips umake when nothing it depends on changes
+import json
+import os
+import os.path as path
+import shutil
+import subprocess
+import pytest
+
+REPO = path.dirname(path.dirname(path.abspath(__file__)))
+
+pytestmark = pytest.mark.skipif(
+    shutil.which("cmake") is None, reason="cmake is not found"
+)
+
+
+def configure(source: str, build: str):
+    subprocess.run(
+        ["cmake", "-S", source, "-B", build, "-DCXX_MODULES_SUPPORTED=1"],
+        check=True,
+        capture_output=True,
+    )
+
+
+def cachedFiles(source: str) -> set[str]:
+    with open(path.join(source, "umakeCache.json")) as cache:
+        return set(json.load(cache))
+
+
+@pytest.fixture
+def project(tmp_path) -> tuple[str, str]:
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "CMakeLists.txt").write_text(
+        "cmake_minimum_required(VERSION 3.15)\n"
+        "project(configure CXX)\n"
+        f'include("{REPO}/umake.cmake")\n'
+        f'add_moduled_executables_with_a_main_source("{REPO}/umake.py" main main.cpp)\n'
+    )
+    (source / "main.cpp").write_text("int main() { return 0; }\n")
+    # Nothing scanned in it
+    (source / "lib").mkdir()
+    (source / "lib" / "README.txt").write_text("Modules to be added.\n")
+    build = str(tmp_path / "build")
+    configure(str(source), build)
+    return str(source), build
+
+
+def test_unchanged(project: tuple[str, str]):
+    source, build = project
+    cache = path.join(source, "umakeCache.json")
+    mtime = path.getmtime(cache)
+    configure(source, build)
+    assert path.getmtime(cache) == mtime
+
+
+def test_new_file_in_new_directory(project: tuple[str, str]):
+    source, build = project
+    assert cachedFiles(source) == {"main.cpp"}
+    lib = path.join(source, "lib", "nested")
+    os.makedirs(lib)
+    with open(path.join(lib, "fresh.ixx"), "w") as file:
+        file.write("export module fresh;\n")
+    configure(source, build)
+    assert path.join("lib", "nested", "fresh.ixx") in cachedFiles(source)
+
+
+def test_new_file_in_scanned_directory(project: tuple[str, str]):
+    source, build = project
+    with open(path.join(source, "fresh.ixx"), "w") as file:
+        file.write("export module fresh;\n")
+    configure(source, build)
+    assert "fresh.ixx" in cachedFiles(source)
+
+
+def test_config_changed(project: tuple[str, str]):
+    source, build = project
+    configPath = path.join(source, "umakeConfig.json")
+    with open(configPath, "w") as config:
+        json.dump({}, config)
+    with open(path.join(source, "fresh.cppx"), "w") as file:
+        file.write("export module fresh;\n")
+    configure(source, build)
+    assert "fresh.cppx" not in cachedFiles(source)
+    # Rewritten in place, so that only the configuration itself is changed
+    with open(configPath, "w") as config:
+        json.dump({"module": [".cppx"]}, config)
+    configure(source, build)
+    assert "fresh.cppx" in cachedFiles(source)
+
+
+@pytest.fixture
+def batch(tmp_path) -> tuple[str, str]:
+    source = tmp_path / "source"
+    (source / "app").mkdir(parents=True)
+    (source / "lib").mkdir()
+    (source / "CMakeLists.txt").write_text(
+        "cmake_minimum_required(VERSION 3.15)\n"
+        "project(batch CXX)\n"
+        f'include("{REPO}/umake.cmake")\n'
+        f'execute_umake_py_for_batch("{REPO}/umake.py" ROOT app main main.cpp ROOT lib)\n'
+        "add_subdirectory(app)\n"
+    )
+    (source / "app" / "CMakeLists.txt").write_text(
+        "add_moduled_executables_from_batch()\n"
+    )
+    (source / "app" / "main.cpp").write_text("int main() { return 0; }\n")
+    build = str(tmp_path / "build")
+    configure(str(source), build)
+    return str(source), build
+
+
+def test_batch_unchanged(batch: tuple[str, str]):
+    source, build = batch
+    cache = path.join(source, "umakeCache.json")
+    mtime = path.getmtime(cache)
+    configure(source, build)
+    assert path.getmtime(cache) == mtime
+
+
+def test_batch_new_file(batch: tuple[str, str]):
+    source, build = batch
+    lib = path.join(source, "lib", "nested")
+    os.makedirs(lib)
+    with open(path.join(lib, "fresh.ixx"), "w") as file:
+        file.write("export module fresh;\n")
+    configure(source, build)
+    assert path.join("lib", "nested", "fresh.ixx") in cachedFiles(source)
@@ -0,0 +1,68 @@
+# Writing results to stdout when its reader stops early, like "umake.py ... | head"
+import json
+import os.path as path
+import subprocess
+import sys
+import pytest
+
+REPO = path.dirname(path.dirname(path.abspath(__file__)))
+
+
+@pytest.fixture
+def tree(tmp_path) -> str:
+    # Large enough to be still writing when the reader is gone
+    src = tmp_path / "src"
+    src.mkdir()
+    for i in range(1500):
+        (src / f"u{i}.cpp").write_text(f'#include "h{i}.h"\nint f{i}();\n')
+        (src / f"h{i}.h").write_text(f"int g{i}();\n")
+    (tmp_path / "main.cpp").write_text("int main() { return 0; }\n")
+    return str(tmp_path)
+
+
+def pipeToHead(tree: str, target: str, lines: int) -> tuple[list[str], str]:
+    umake = subprocess.Popen(
+        [sys.executable, path.join(REPO, "umake.py"), "--root", ".", "--target"]
+        + [target, "main", "main.cpp"],
+        cwd=tree,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    head = subprocess.run(
+        ["head", f"-{lines}"], stdin=umake.stdout, capture_output=True, text=True
+    )
+    umake.stdout.close()
+    stderr = umake.stderr.read().decode()
+    umake.stderr.close()
+    umake.wait()
+    return head.stdout.splitlines(), stderr
+
+
+def cacheSize(tree: str) -> int:
+    return path.getsize(path.join(tree, "umakeCache.json"))
+
+
+def test_report_dot(tree: str):
+    subprocess.run(
+        [sys.executable, path.join(REPO, "umake.py"), "--root", "."]
+        + ["--target", "cmake", "main", "main.cpp"],
+        cwd=tree,
+        check=True,
+        capture_output=True,
+    )
+    size = cacheSize(tree)
+    lines, stderr = pipeToHead(tree, "report-dot", 3)
+    assert lines[0] == "digraph umake {"
+    assert "Traceback" not in stderr and "Broken pipe" not in stderr
+    assert cacheSize(tree) == size
+    assert path.exists(path.join(tree, "umakeReverseIndex.json"))
+
+
+def test_ndjson(tree: str):
+    lines, stderr = pipeToHead(tree, "ndjson", 1)
+    assert json.loads(lines[0])["type"] == "header"
+    assert "Traceback" not in stderr and "Broken pipe" not in stderr
+    # Scanning goes on after the reader is gone
+    with open(path.join(tree, "umakeCache.json")) as file:
+        cache = json.load(file)
+    assert "main.cpp" in cache and len(cache) == 3001
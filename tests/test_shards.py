@@ -0,0 +1,96 @@
+# Scanning in shards with --shard and combining fragments with --merge
+import json
+import os.path as path
+import subprocess
+import sys
+import pytest
+
+REPO = path.dirname(path.dirname(path.abspath(__file__)))
+SHARDS = 3
+
+
+def command(*args: str) -> list[str]:
+    return [sys.executable, path.join(REPO, "umake.py"), "--root", ".", *args]
+
+
+def umake(root: str, *args: str) -> subprocess.CompletedProcess[str]:
+    return subprocess.run(
+        command(*args), cwd=root, check=True, capture_output=True, text=True
+    )
+
+
+def fragment(root: str, index: int) -> str:
+    return path.join(root, f"umakeCache.shard-{index}-of-{SHARDS}.json")
+
+
+@pytest.fixture
+def tree(tmp_path) -> str:
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "a.cppm").write_text("export module a;\nexport int a() { return 1; }\n")
+    (src / "b.cppm").write_text(
+        'export module b;\nimport a;\n#include "util.h"\n'
+        "export int b() { return a(); }\n"
+    )
+    (src / "util.h").write_text("int util();\n")
+    (src / "util.cpp").write_text('#include "util.h"\nint util() { return 0; }\n')
+    (tmp_path / "main.cpp").write_text("import b;\nint main() { return b(); }\n")
+    return str(tmp_path)
+
+
+def scanInShards(root: str):
+    shards = [
+        subprocess.Popen(
+            command("--shard", f"{index}/{SHARDS}"),
+            cwd=root,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        for index in range(SHARDS)
+    ]
+    assert [shard.wait() for shard in shards] == [0] * SHARDS
+
+
+def test_merged_as_plain(tree: str):
+    plain = umake(tree, "--no-cache", "--target", "cmake", "main", "main.cpp")
+    scanInShards(tree)
+    merged = umake(tree, "--merge", "--target", "cmake", "main", "main.cpp")
+    assert merged.stdout == plain.stdout
+    with open(path.join(tree, "umakeCache.json")) as cache:
+        assert set(json.load(cache)) == {
+            "main.cpp",
+            "src/a.cppm",
+            "src/b.cppm",
+            "src/util.cpp",
+            "src/util.h",
+        }
+
+
+def test_collision_keeps_cache(tree: str):
+    scanInShards(tree)
+    umake(tree, "--merge", "--target", "cmake", "main", "main.cpp")
+    with open(path.join(tree, "umakeCache.json")) as cache:
+        saved = cache.read()
+
+    # Scanned again with a new file, which must not reach cache if merging fails
+    with open(path.join(tree, "src", "extra.cpp"), "w") as extra:
+        extra.write("int extra() { return 0; }\n")
+    scanInShards(tree)
+    # Another file providing module a, as if scanned from another checkout
+    fragments = []
+    for index in range(SHARDS):
+        with open(fragment(tree, index)) as file:
+            fragments.append(json.load(file))
+    (provider,) = [s for s in fragments if "src/a.cppm" in s["dependencies"]]
+    other = (fragments.index(provider) + 1) % SHARDS
+    fragments[other]["dependencies"]["src/copy.cppm"] = provider["dependencies"][
+        "src/a.cppm"
+    ]
+    with open(fragment(tree, other), "w") as file:
+        json.dump(fragments[other], file)
+
+    merged = umake(tree, "--merge", "--target", "cmake", "main", "main.cpp")
+    assert 'Module "a" is provided by both' in merged.stderr
+    assert "src/copy.cppm" in merged.stderr
+    with open(path.join(tree, "umakeCache.json")) as cache:
+        assert cache.read() == saved
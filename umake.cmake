@@ -11,8 +11,20 @@ include(CheckCXXCompilerFlag)
 set(CXX_DEFINITION_HEAD -D)
 set(CXX_PRECOMPILED_MODULES_DIR ${CMAKE_CURRENT_BINARY_DIR}/.cppm)
 set(CXX_MODULES_PRECOMPILE_WHEN_COMPILE FALSE)
+# Reuse precompiled modules and objects of module interfaces with same inputs, see bmicache.py
+option(UMAKE_BMI_CACHE "Launch compilers of module interfaces through bmicache.py" OFF)
+set(UMAKE_BMI_CACHE_PY ${CMAKE_CURRENT_LIST_DIR}/bmicache.py)
 
 set(UMAKE_FLAG_MODE)
+
+# Type of libraries created for module interfaces
+# Select object libraries would cause errors if you use Visual Studio generators
+if("${CMAKE_GENERATOR}" STREQUAL Ninja)
+    set(UMAKE_MODULE_LIBRARY_TYPE OBJECT)
+else()
+    set(UMAKE_MODULE_LIBRARY_TYPE STATIC)
+endif()
+
 if(MSVC)
     # See https://docs.microsoft.com/en-us/cpp/preprocessor/predefined-macros
     # See https://docs.microsoft.com/en-us/cpp/error-messages/compiler-warnings/c5050
@@ -38,6 +50,12 @@ if(MSVC)
     endif()
     set(UMAKE_FLAG_MODE SPACE)
 
+    set(CXX_HEADER_UNIT_CREATE_FLAGS /nologo /std:c++latest /c /exportHeader)
+    set(CXX_HEADER_UNIT_SYSTEM_FLAG /headerName:angle)
+    set(CXX_HEADER_UNIT_LOCAL_FLAG)
+    set(CXX_HEADER_UNIT_OUTPUT_FLAG /ifcOutput)
+    set(CXX_HEADER_UNIT_OBJECT_FLAG /Fo)
+
     if(NOT ${CXX_MODULES_PRECOMPILE_WHEN_COMPILE})
         if(NOT CMAKE_CXX_STANDARD)
             set(CXX_MODULES_VERSION_FLAG "/std:c++20")
@@ -56,6 +74,12 @@ else() # Any more check?
     set(CXX_MODULES_REFERENCES_FLAG -fprebuilt-module-path=)
     set(CXX_MODULES_REFERENCE_DIRECTORY TRUE)
     set(CXX_PRECOMPILED_MODULE_INTERFACE_OUTPUT_FLAG -o)
+
+    set(CXX_HEADER_UNIT_CREATE_FLAGS --precompile)
+    set(CXX_HEADER_UNIT_SYSTEM_FLAG -xc++-system-header)
+    set(CXX_HEADER_UNIT_LOCAL_FLAG -xc++-user-header)
+    set(CXX_HEADER_UNIT_OUTPUT_FLAG -o)
+    set(CXX_HEADER_UNIT_OBJECT_FLAG)
     if(NOT ${CXX_MODULES_PRECOMPILE_WHEN_COMPILE})
         if(NOT CMAKE_CXX_STANDARD)
             set(CXX_MODULES_VERSION_FLAG "-std=c++20")
@@ -124,8 +148,145 @@ function(add_object_dependency SOURCE REFERENCE)
     endif()
 endfunction()
 
+# Flags for importing a header unit created by add_header_unit
+function(header_unit_reference_flags OUT HEADER_UNIT)
+    get_target_property(HEADER ${HEADER_UNIT} CXX_HEADER_UNIT_HEADER)
+    get_target_property(SYSTEM ${HEADER_UNIT} CXX_HEADER_UNIT_SYSTEM)
+    get_target_property(FILE ${HEADER_UNIT} CXX_HEADER_UNIT_FILE)
+    if(MSVC)
+        if(SYSTEM)
+            set(FLAGS /headerUnit:angle ${HEADER}=${FILE})
+        else()
+            set(FLAGS /headerUnit ${HEADER}=${FILE})
+        endif()
+    else()
+        set(FLAGS -fmodule-file=${FILE})
+    endif()
+    set(${OUT} ${FLAGS} PARENT_SCOPE)
+endfunction()
+
+# Add header unit dependencies to the target and flags to its sources.
+# Flags are not added to the target, as its compile options are joined when precompiling modules,
+# and they are not de-duplicated in COMPILE_FLAGS.
+function(target_add_header_unit_dependencies TARGET HEADER_UNIT)
+    add_dependencies(${TARGET} ${HEADER_UNIT})
+    header_unit_reference_flags(FLAGS ${HEADER_UNIT})
+    list(JOIN FLAGS " " FLAGS)
+    foreach(SOURCE IN LISTS ARGN)
+        set_property(SOURCE ${SOURCE} APPEND_STRING PROPERTY COMPILE_FLAGS " ${FLAGS}")
+    endforeach()
+    message(DEBUG "${TARGET} has a dependency on ${HEADER_UNIT}")
+endfunction()
+
+## Create C++ header unit, which is built only once for all importers.
+## add_header_unit(TARGET [SYSTEM <HEADER>] [SOURCE <SOURCE>] [REFERENCE <HEADER_UNIT> ...])
+## Set target property below:
+##  CXX_HEADER_UNIT_HEADER      Header name from library, or absolute path of local header
+##  CXX_HEADER_UNIT_SYSTEM      Whether the header is from library
+##  CXX_HEADER_UNIT_FILE        Precompiled header unit path
+function(add_header_unit TARGET)
+    # Header units might be imported from several directories
+    if(TARGET ${TARGET})
+        return()
+    endif()
+
+    set(SYSTEMS)
+    set(SOURCES)
+    set(REFERENCES)
+    set(MODE)
+    foreach(TOKEN IN LISTS ARGN)
+        if(${TOKEN} STREQUAL SYSTEM)
+            set(MODE ${TOKEN})
+        elseif(${TOKEN} STREQUAL SOURCE)
+            set(MODE ${TOKEN})
+        elseif(${TOKEN} STREQUAL REFERENCE)
+            set(MODE ${TOKEN})
+        else()
+            if(NOT MODE)
+                message(FATAL_ERROR "Mode not set.")
+            endif()
+            list(APPEND ${MODE}S ${TOKEN})
+        endif()
+    endforeach()
+
+    set(OUT_FILE ${CXX_PRECOMPILED_MODULES_DIR}/${TARGET}.${CXX_PRECOMPILED_MODULES_EXT})
+    file(MAKE_DIRECTORY ${CXX_PRECOMPILED_MODULES_DIR})
+
+    set(LAUNCHER)
+    set(REFERENCE_FILES)
+    foreach(REFERENCE IN LISTS REFERENCES)
+        get_target_property(FILE ${REFERENCE} CXX_HEADER_UNIT_FILE)
+        list(APPEND REFERENCE_FILES ${FILE})
+    endforeach()
+    if(UMAKE_BMI_CACHE)
+        list(APPEND LAUNCHER python ${UMAKE_BMI_CACHE_PY})
+        foreach(FILE IN LISTS REFERENCE_FILES)
+            list(APPEND LAUNCHER --reference ${FILE})
+        endforeach()
+        list(APPEND LAUNCHER --)
+    endif()
+
+    set(cmd ${LAUNCHER} ${CMAKE_CXX_COMPILER})
+    list(APPEND cmd ${CXX_MODULES_VERSION_FLAG})
+    list(APPEND cmd ${CXX_HEADER_UNIT_CREATE_FLAGS})
+    if(SYSTEMS)
+        set(SYSTEM TRUE)
+        set(HEADER ${SYSTEMS})
+        set(DEPENDS)
+        list(APPEND cmd ${CXX_HEADER_UNIT_SYSTEM_FLAG} ${HEADER})
+    else()
+        set(SYSTEM FALSE)
+        set(HEADER ${CMAKE_CURRENT_SOURCE_DIR}/${SOURCES})
+        set(DEPENDS ${HEADER})
+        list(APPEND cmd ${CXX_HEADER_UNIT_LOCAL_FLAG} ${HEADER})
+    endif()
+    list(APPEND cmd ${CXX_HEADER_UNIT_OUTPUT_FLAG} ${OUT_FILE})
+    if(CXX_HEADER_UNIT_OBJECT_FLAG)
+        list(APPEND cmd ${CXX_HEADER_UNIT_OBJECT_FLAG}${OUT_FILE}${CMAKE_CXX_OUTPUT_EXTENSION})
+    endif()
+    foreach(REFERENCE IN LISTS REFERENCES)
+        header_unit_reference_flags(FLAGS ${REFERENCE})
+        list(APPEND cmd ${FLAGS})
+    endforeach()
+
+    # Add definitions and flags, as header units should be compiled like their importers
+    get_property(compile_definitions DIRECTORY PROPERTY COMPILE_DEFINITIONS)
+    foreach(definition IN LISTS compile_definitions)
+        list(APPEND cmd ${CXX_DEFINITION_HEAD}${definition})
+    endforeach()
+
+    separate_arguments(FLAGS NATIVE_COMMAND ${CMAKE_CXX_FLAGS})
+    list(APPEND cmd ${FLAGS})
+
+    if(CMAKE_BUILD_TYPE)
+        string(TOUPPER ${CMAKE_BUILD_TYPE} UPPER_BUILD_TYPE)
+        if(CMAKE_CXX_FLAGS_${UPPER_BUILD_TYPE})
+            separate_arguments(FLAGS NATIVE_COMMAND ${CMAKE_CXX_FLAGS_${UPPER_BUILD_TYPE}})
+            list(APPEND cmd ${FLAGS})
+        endif()
+    endif()
+
+    add_custom_command(
+        OUTPUT ${OUT_FILE}
+        COMMAND ${cmd}
+        DEPENDS ${DEPENDS} ${REFERENCES}
+        WORKING_DIRECTORY ${CMAKE_CURRENT_BINARY_DIR}
+    )
+    add_custom_target(${TARGET} DEPENDS ${OUT_FILE})
+    foreach(REFERENCE IN LISTS REFERENCES)
+        add_dependencies(${TARGET} ${REFERENCE})
+    endforeach()
+
+    set_target_properties(${TARGET}
+        PROPERTIES
+        CXX_HEADER_UNIT_HEADER "${HEADER}"
+        CXX_HEADER_UNIT_SYSTEM "${SYSTEM}"
+        CXX_HEADER_UNIT_FILE "${OUT_FILE}"
+    )
+endfunction()
+
 ## Create C++ module interface.
-## add_module_library(TARGET SOURCE <SOURCE> [REFERENCE <REFERENCE> ...] [DEPEND <DEPEND> ...])
+## add_module_library(TARGET SOURCE <SOURCE> [REFERENCE <REFERENCE> ...] [DEPEND <DEPEND> ...] [HEADER_UNIT <HEADER_UNIT> ...])
 ## Set target property below:
 ##  CXX_MODULE_NAME             Unescaped module name
 ##  CXX_MODULE_INTERFACE_FILE   Source file path
@@ -142,12 +303,15 @@ function (add_module_library TARGET _SOURCE SOURCE)
     set(HAS_IMPLEMENT FALSE)
     set(DEPENDS)
     set(REFERENCES)
+    set(HEADER_UNITS)
     set(MODE)
     foreach(TOKEN IN LISTS ARGN)
         if(${TOKEN} STREQUAL DEPEND)
             set(MODE ${TOKEN})
         elseif(${TOKEN} STREQUAL REFERENCE)
             set(MODE ${TOKEN})
+        elseif(${TOKEN} STREQUAL HEADER_UNIT)
+            set(MODE ${TOKEN})
         elseif(${TOKEN} STREQUAL IMPLEMENT)
             set(HAS_IMPLEMENT TRUE)
         else()
@@ -162,24 +326,9 @@ function (add_module_library TARGET _SOURCE SOURCE)
     if(IS_ABSOLUTE ${SOURCE})
         file(RELATIVE_PATH SOURCE ${CMAKE_CURRENT_SOURCE_DIR} ${SOURCE})
     endif()
-    string(REPLACE ":" "-" ESCAPED_MODULE_NAME ${TARGET})
-    set(OUT_FILE ${CXX_PRECOMPILED_MODULES_DIR}/${ESCAPED_MODULE_NAME}.${CXX_PRECOMPILED_MODULES_EXT})
-    set(IN_FILE ${CMAKE_CURRENT_SOURCE_DIR}/${SOURCE})
-
-    # Make directory for pre-compiled modules
-    get_filename_component(OUT_FILE_DIR ${OUT_FILE} DIRECTORY)
-
-    if (OUT_FILE_DIR)
-        file(MAKE_DIRECTORY ${OUT_FILE_DIR})
-    endif()
 
     # Create interface build target
-    # Select object libraries would cause errors if you use Visual Studio generators
-    if("${CMAKE_GENERATOR}" STREQUAL Ninja)
-        add_library(${ESCAPED_TARGET} OBJECT ${SOURCE} ${IMPLEMENTS})
-    else()
-        add_library(${ESCAPED_TARGET} STATIC ${SOURCE} ${IMPLEMENTS})
-    endif()
+    add_library(${ESCAPED_TARGET} ${UMAKE_MODULE_LIBRARY_TYPE} ${SOURCE} ${IMPLEMENTS})
 
 
     if(${CXX_MODULES_REFERENCE_DIRECTORY})
@@ -200,6 +349,46 @@ function (add_module_library TARGET _SOURCE SOURCE)
         endif()
         add_object_dependency(${SOURCE} ${ESCAPED_REFERENCE})
     endforeach()
+    foreach(HEADER_UNIT IN LISTS HEADER_UNITS)
+        target_add_header_unit_dependencies(${ESCAPED_TARGET} ${HEADER_UNIT} ${SOURCE} ${IMPLEMENTS})
+    endforeach()
+
+    precompile_module_interface(${TARGET} ${SOURCE} "${REFERENCES}" "${HEADER_UNITS}" ${HAS_IMPLEMENT})
+endfunction ()
+
+## Precompile C++ module interface of target created by add_module_library or umakeGenerated.cmake.
+## precompile_module_interface(TARGET SOURCE <REFERENCES> <HEADER_UNITS> <HAS_IMPLEMENT>)
+## Set target property below:
+##  CXX_MODULE_NAME             Unescaped module name
+##  CXX_MODULE_INTERFACE_FILE   Source file path
+##  CXX_MODULE_REFERENCES       Escaped names of referenced modules
+function(precompile_module_interface TARGET SOURCE REFERENCES HEADER_UNITS HAS_IMPLEMENT)
+    string(REPLACE ":" "-" ESCAPED_TARGET ${TARGET})
+    set(OUT_FILE ${CXX_PRECOMPILED_MODULES_DIR}/${ESCAPED_TARGET}.${CXX_PRECOMPILED_MODULES_EXT})
+    set(IN_FILE ${CMAKE_CURRENT_SOURCE_DIR}/${SOURCE})
+
+    # Make directory for pre-compiled modules
+    get_filename_component(OUT_FILE_DIR ${OUT_FILE} DIRECTORY)
+
+    if (OUT_FILE_DIR)
+        file(MAKE_DIRECTORY ${OUT_FILE_DIR})
+    endif()
+
+    # Referenced precompiled modules are part of the key for caching
+    set(LAUNCHER)
+    if(UMAKE_BMI_CACHE)
+        list(APPEND LAUNCHER python ${UMAKE_BMI_CACHE_PY})
+        foreach (REFERENCE IN LISTS REFERENCES)
+            string(REPLACE ":" "-" ESCAPED_REFERENCE ${REFERENCE})
+            list(APPEND LAUNCHER --reference ${CXX_PRECOMPILED_MODULES_DIR}/${ESCAPED_REFERENCE}.${CXX_PRECOMPILED_MODULES_EXT})
+        endforeach()
+        foreach(HEADER_UNIT IN LISTS HEADER_UNITS)
+            get_target_property(FILE ${HEADER_UNIT} CXX_HEADER_UNIT_FILE)
+            list(APPEND LAUNCHER --reference ${FILE})
+        endforeach()
+        list(APPEND LAUNCHER --)
+        set_target_properties(${ESCAPED_TARGET} PROPERTIES CXX_COMPILER_LAUNCHER "${LAUNCHER}")
+    endif()
 
     if(${CXX_MODULES_PRECOMPILE_WHEN_COMPILE})
         if(CMAKE_GENERATOR MATCHES "Visual Studio [0-9 ]*")
@@ -211,7 +400,7 @@ function (add_module_library TARGET _SOURCE SOURCE)
         endif()
     else()
         # TODO: CXX flags might be different
-        set(cmd ${CMAKE_CXX_COMPILER})
+        set(cmd ${LAUNCHER} ${CMAKE_CXX_COMPILER})
         list(APPEND cmd ${CXX_MODULES_FLAGS})
         list(APPEND cmd ${CXX_MODULES_VERSION_FLAG})
         list(APPEND cmd ${CXX_MODULES_CREATE_FLAGS} ${IN_FILE})
@@ -233,6 +422,10 @@ function (add_module_library TARGET _SOURCE SOURCE)
             endif()
             list(APPEND ESCAPED_REFERENCES ${ESCAPED_REFERENCE})
         endforeach ()
+        foreach(HEADER_UNIT IN LISTS HEADER_UNITS)
+            header_unit_reference_flags(FLAGS ${HEADER_UNIT})
+            list(APPEND cmd ${FLAGS})
+        endforeach()
 
         # Add definitions and flags to the target
         get_property(compile_definitions DIRECTORY PROPERTY COMPILE_DEFINITIONS)
@@ -263,7 +456,7 @@ function (add_module_library TARGET _SOURCE SOURCE)
         add_custom_command(
             OUTPUT ${OUT_FILE}
             COMMAND ${cmd}
-            DEPENDS ${IN_FILE} ${ESCAPED_REFERENCES}
+            DEPENDS ${IN_FILE} ${ESCAPED_REFERENCES} ${HEADER_UNITS}
             WORKING_DIRECTORY ${CMAKE_CURRENT_BINARY_DIR}
         )
         set(PRECOMPILING_TARGET ".PRECOMPILED.${ESCAPED_TARGET}")
@@ -322,12 +515,15 @@ function(add_module_implement TARGET _SOURCE SOURCE)
 
     set(DEPENDS)
     set(REFERENCES)
+    set(HEADER_UNITS)
     set(MODE)
     foreach(TOKEN IN LISTS ARGN)
         if(${TOKEN} STREQUAL DEPEND)
             set(MODE ${TOKEN})
         elseif(${TOKEN} STREQUAL REFERENCE)
             set(MODE ${TOKEN})
+        elseif(${TOKEN} STREQUAL HEADER_UNIT)
+            set(MODE ${TOKEN})
         else()
             if(NOT MODE)
                 message(FATAL_ERROR "Mode not set.")
@@ -366,6 +562,9 @@ function(add_module_implement TARGET _SOURCE SOURCE)
         endif()
         add_object_dependency(${SOURCE} ${ESCAPED_REFERENCE})
     endforeach()
+    foreach(HEADER_UNIT IN LISTS HEADER_UNITS)
+        target_add_header_unit_dependencies(${IMPLEMENT_TARGET} ${HEADER_UNIT} ${SOURCE})
+    endforeach()
 endfunction()
 
 ## Link a (C++ module) library to (C++ module) target.
@@ -379,6 +578,7 @@ function (add_moduled_executable TARGET)
     set(SOURCES)
     set(DEPENDS)
     set(REFERENCES)
+    set(HEADER_UNITS)
     set(MODE SOURCE)
     foreach(TOKEN IN LISTS ARGN)
         if(${TOKEN} STREQUAL SOURCE)
@@ -387,6 +587,8 @@ function (add_moduled_executable TARGET)
             set(MODE ${TOKEN})
         elseif(${TOKEN} STREQUAL REFERENCE)
             set(MODE ${TOKEN})
+        elseif(${TOKEN} STREQUAL HEADER_UNIT)
+            set(MODE ${TOKEN})
         else()
             list(APPEND ${MODE}S ${TOKEN})
         endif()
@@ -424,6 +626,9 @@ function (add_moduled_executable TARGET)
             add_object_dependency(${SOURCE} ${ESCAPED_REFERENCE})
         endforeach()
     endforeach ()
+    foreach(HEADER_UNIT IN LISTS HEADER_UNITS)
+        target_add_header_unit_dependencies(${TARGET} ${HEADER_UNIT} ${SOURCES})
+    endforeach()
 endfunction ()
 
 ## Link a (C++ module) library to (C++ module) target.
@@ -437,6 +642,7 @@ function (add_moduled_library TARGET)
     set(SOURCES)
     set(DEPENDS)
     set(REFERENCES)
+    set(HEADER_UNITS)
     set(MODE SOURCE)
     set(TYPE)
     foreach(TOKEN IN LISTS ARGN)
@@ -454,6 +660,8 @@ function (add_moduled_library TARGET)
             set(MODE ${TOKEN})
         elseif(${TOKEN} STREQUAL REFERENCE)
             set(MODE ${TOKEN})
+        elseif(${TOKEN} STREQUAL HEADER_UNIT)
+            set(MODE ${TOKEN})
         else()
             list(APPEND ${MODE}S ${TOKEN})
         endif()
@@ -489,6 +697,9 @@ function (add_moduled_library TARGET)
             add_object_dependency(${SOURCE} ${ESCAPED_REFERENCE})
         endforeach()
     endforeach ()
+    foreach(HEADER_UNIT IN LISTS HEADER_UNITS)
+        target_add_header_unit_dependencies(${TARGET} ${HEADER_UNIT} ${SOURCES})
+    endforeach()
 endfunction ()
 
 ## Create static libraries that correspond to single source file.
@@ -502,6 +713,7 @@ function(add_source_file_target TARGET)
     set(SOURCES)
     set(DEPENDS)
     set(REFERENCES)
+    set(HEADER_UNITS)
     set(MODE SOURCES)
     foreach(TOKEN IN LISTS ARGN)
         if(${TOKEN} STREQUAL SOURCE)
@@ -510,6 +722,8 @@ function(add_source_file_target TARGET)
             set(MODE ${TOKEN})
         elseif(${TOKEN} STREQUAL REFERENCE)
             set(MODE ${TOKEN})
+        elseif(${TOKEN} STREQUAL HEADER_UNIT)
+            set(MODE ${TOKEN})
         else()
             list(APPEND ${MODE}S ${TOKEN})
         endif()
@@ -542,15 +756,20 @@ function(add_source_file_target TARGET)
             add_object_dependency(${SOURCE} ${ESCAPED_REFERENCE})
         endforeach()
     endforeach ()
+    foreach(HEADER_UNIT IN LISTS HEADER_UNITS)
+        target_add_header_unit_dependencies(${TARGET} ${HEADER_UNIT} ${SOURCES})
+    endforeach()
 endfunction()
 
 function(execute_umake_command_for_executable command)
     # Run "cmake --help-policy CMP0054" for help
     cmake_policy(SET CMP0054 NEW)
     string(REPLACE "\\" "/" command ${command})
-    string(REGEX MATCHALL "[0-9/:._a-zA-Z-]+" cmds "${command}")
+    string(REGEX MATCHALL "[0-9/:._a-zA-Z+-]+" cmds "${command}")
     list(POP_FRONT cmds head)
-    if("MODULE" STREQUAL ${head})
+    if("HEADER_UNIT" STREQUAL ${head})
+        add_header_unit(${cmds})
+    elseif("MODULE" STREQUAL ${head})
         add_module_library(${cmds})
     elseif("TARGET" STREQUAL ${head})
         add_moduled_executable(${cmds})
@@ -567,9 +786,11 @@ function(execute_umake_command_for_library command)
     # Run "cmake --help-policy CMP0054" for help
     cmake_policy(SET CMP0054 NEW)
     string(REPLACE "\\" "/" command ${command})
-    string(REGEX MATCHALL "[0-9/:._a-zA-Z-]+" cmds "${command}")
+    string(REGEX MATCHALL "[0-9/:._a-zA-Z+-]+" cmds "${command}")
     list(POP_FRONT cmds head)
-    if("MODULE" STREQUAL ${head})
+    if("HEADER_UNIT" STREQUAL ${head})
+        add_header_unit(${cmds})
+    elseif("MODULE" STREQUAL ${head})
         add_module_library(${cmds})
     elseif("TARGET" STREQUAL ${head})
         add_moduled_library(${cmds})
@@ -582,48 +803,107 @@ function(execute_umake_command_for_library command)
     endif()
 endfunction()
 
-function(EXECUTE_UMAKE_PY_FOR_DEPENDENCIES OUT)
-    # Check if ARGC is odd.
-    # Odd ARGC means path to umake.py is specified
-    math(EXPR ODD "(${ARGC}-1)%2")
+# Find umake.py when its path is not specified.
+function(find_umake_py OUT)
+    if(${CMAKE_VERSION} VERSION_GREATER 3.19 AND EXISTS "umakeConfig.json")
+        file(STRINGS "umakeConfig.json" configJSON)
+        string(JSON UMAKE_PATH GET ${configJSON} "umake.py")
+    elseif(EXISTS "umake.py")
+        set(UMAKE_PATH "umake.py")
+        message(WARNING "Configuration does not exist or can't be parsed, use current dir.")
+    elseif(CMAKE_CURRENT_FUNCTION_LIST_DIR AND EXISTS "${CMAKE_CURRENT_FUNCTION_LIST_DIR}/umake.py")
+        set(UMAKE_PATH "${CMAKE_CURRENT_FUNCTION_LIST_DIR}/umake.py")
+        message("Using current function list dir.")
+    else()
+        message(FATAL_ERROR "Please specify umake path.")
+    endif()
+    set(${OUT} ${UMAKE_PATH} PARENT_SCOPE)
+endfunction()
+
+## Check if umake needs not to be run again.
+##  umake_is_up_to_date(OUT STAMP COMMAND [<CONFIGURE_DEPENDS1> ...])
+##  OUT is TRUE if STAMP records the same COMMAND,
+##  and nothing listed in any of the configure depends files is newer than STAMP.
+function(umake_is_up_to_date OUT STAMP COMMAND)
+    set(${OUT} FALSE PARENT_SCOPE)
+    if(NOT EXISTS ${STAMP})
+        return()
+    endif()
+    file(READ ${STAMP} LAST_COMMAND)
+    if(NOT "${LAST_COMMAND}" STREQUAL "${COMMAND}")
+        return()
+    endif()
+    foreach(CONFIGURE_DEPENDS IN LISTS ARGN)
+        if(NOT EXISTS ${CONFIGURE_DEPENDS})
+            return()
+        endif()
+        file(READ ${CONFIGURE_DEPENDS} DEPENDS)
+        foreach(DEPEND IN LISTS DEPENDS)
+            if(NOT EXISTS ${DEPEND} OR ${DEPEND} IS_NEWER_THAN ${STAMP})
+                return()
+            endif()
+        endforeach()
+    endforeach()
+    set(${OUT} TRUE PARENT_SCOPE)
+endfunction()
+
+## Run umake.py with given target, which writes GENERATED under current list dir.
+##  execute_umake_py(UMAKE_TARGET GENERATED [UMAKE_PATH] [<TARGET_NAME1> <SOURCE1> ...])
+function(execute_umake_py UMAKE_TARGET GENERATED)
+    # Check if count of other arguments is odd.
+    # Odd count means path to umake.py is specified
+    list(LENGTH ARGN COUNT)
+    math(EXPR ODD "${COUNT}%2")
     if(ODD)
         list(POP_FRONT ARGN UMAKE_PATH)
     else()
-        if(${CMAKE_VERSION} VERSION_GREATER 3.19 AND EXISTS "umakeConfig.json")
-            file(STRINGS "umakeConfig.json" configJSON)
-            string(JSON UMAKE_PATH GET ${configJSON} "umake.py")
-        elseif(EXISTS "umake.py")
-            set(UMAKE_PATH "umake.py")
-            message(WARNING "Configuration does not exist or can't be parsed, use current dir.")
-        elseif(CMAKE_CURRENT_FUNCTION_LIST_DIR AND EXISTS "${CMAKE_CURRENT_FUNCTION_LIST_DIR}/umake.py")
-            set(UMAKE_PATH "${CMAKE_CURRENT_FUNCTION_LIST_DIR}/umake.py")
-            message("Using current function list dir.")
-        else()
-            message(FATAL_ERROR "Please specify umake path.")
-        endif()
+        find_umake_py(UMAKE_PATH)
     endif()
 
     if(EXISTS "${CMAKE_CURRENT_LIST_DIR}/umakeConfig.json")
         set(CONFIG_FLAGS "--load-config")
     endif()
 
-    execute_process(
-        COMMAND python ${UMAKE_PATH} ${CONFIG_FLAGS} --root ${CMAKE_CURRENT_LIST_DIR} --target cmake ${ARGN}
-        # COMMAND_ECHO STDOUT
-        OUTPUT_VARIABLE RESULT
-        ERROR_VARIABLE ERROR
-        WORKING_DIRECTORY ${CMAKE_CURRENT_LIST_DIR}
-    )
-    message(VERBOSE ${RESULT})
-    if(ERROR)
-        if(RESULT)
-            message("STDOUT:")
-            message(${RESULT})
+    set(CONFIGURE_DEPENDS "${CMAKE_CURRENT_LIST_DIR}/umakeConfigureDepends.txt")
+    set(STAMP "${CMAKE_CURRENT_BINARY_DIR}/${GENERATED}.stamp")
+    set(GENERATED "${CMAKE_CURRENT_LIST_DIR}/${GENERATED}")
+    set(COMMAND python ${UMAKE_PATH} ${CONFIG_FLAGS} --root ${CMAKE_CURRENT_LIST_DIR} --target ${UMAKE_TARGET} ${ARGN})
+
+    # umake is not run again unless arguments or scanned files are changed since last run
+    set(UP_TO_DATE FALSE)
+    if(EXISTS ${GENERATED})
+        umake_is_up_to_date(UP_TO_DATE ${STAMP} "${COMMAND}" ${CONFIGURE_DEPENDS})
+    endif()
+
+    if(UP_TO_DATE)
+        message(VERBOSE "Scanned files are not changed, skip running umake.")
+    else()
+        execute_process(
+            COMMAND ${COMMAND}
+            # COMMAND_ECHO STDOUT
+            OUTPUT_VARIABLE RESULT
+            ERROR_VARIABLE ERROR
+            WORKING_DIRECTORY ${CMAKE_CURRENT_LIST_DIR}
+        )
+        message(VERBOSE ${RESULT})
+        if(ERROR)
+            if(RESULT)
+                message("STDOUT:")
+                message(${RESULT})
+            endif()
+            message("STDERR")
+            message(${ERROR})
+            message(FATAL_ERROR "Error detected during scanning dependencies.")
         endif()
-        message("STDERR")
-        message(${ERROR})
-        message(FATAL_ERROR "Error detected during scanning dependencies.")
+        file(WRITE ${STAMP} "${COMMAND}")
     endif()
+    file(READ ${CONFIGURE_DEPENDS} DEPENDS)
+    set_property(DIRECTORY APPEND PROPERTY CMAKE_CONFIGURE_DEPENDS ${DEPENDS})
+endfunction()
+
+function(EXECUTE_UMAKE_PY_FOR_DEPENDENCIES OUT)
+    execute_umake_py(cmake-store umakeGenerated.txt ${ARGN})
+    file(READ "${CMAKE_CURRENT_LIST_DIR}/umakeGenerated.txt" RESULT)
     set(${OUT} ${RESULT} PARENT_SCOPE)
 endfunction()
 
@@ -663,4 +943,137 @@ function(add_moduled_library_with_a_main_source)
     foreach(cmd IN LISTS RESULT)
         execute_umake_command_for_library(${cmd} ${TYPE})
     endforeach(cmd)
-endfunction()
\ No newline at end of file
+endfunction()
+
+# add_moduled_executables_from_script([UMAKE_PATH] [<TARGET_NAME1> <SOURCE1> [<TARGET_NAME2> <SOURCE2>]...])
+# Same as add_moduled_executables_with_a_main_source, but umake.py writes a script to be included.
+function(add_moduled_executables_from_script)
+    execute_umake_py(cmake-script umakeGenerated.cmake ${ARGN})
+    set(UMAKE_TARGETS_AS_LIBRARIES FALSE)
+    include("${CMAKE_CURRENT_LIST_DIR}/umakeGenerated.cmake")
+endfunction()
+
+# add_moduled_library_from_script([STATIC|SHARED|MODULE|OBJECT] [UMAKE_PATH] [<TARGET_NAME1> <SOURCE1> [<TARGET_NAME2> <SOURCE2>]...])
+# Same as add_moduled_library_with_a_main_source, but umake.py writes a script to be included.
+function(add_moduled_library_from_script)
+    set(UMAKE_LIBRARY_TYPE)
+    if(ARGN)
+        list(GET ARGN 0 TYPE)
+        if(TYPE MATCHES "^(STATIC|SHARED|MODULE|OBJECT)$")
+            set(UMAKE_LIBRARY_TYPE ${TYPE})
+            list(POP_FRONT ARGN)
+        endif()
+    endif()
+    execute_umake_py(cmake-script umakeGenerated.cmake ${ARGN})
+    set(UMAKE_TARGETS_AS_LIBRARIES TRUE)
+    include("${CMAKE_CURRENT_LIST_DIR}/umakeGenerated.cmake")
+endfunction()
+
+## Scan dependencies of several roots (usually subdirectories) by running umake only once.
+##  execute_umake_py_for_batch([UMAKE_PATH] ROOT <ROOT1> [<TARGET_NAME1> <SOURCE1> ...] [ROOT <ROOT2> ...])
+##  Call it once on top level before add_subdirectory, and results are stored under every root.
+##  Then call add_moduled_executables_from_batch or add_moduled_library_from_batch in each root.
+function(execute_umake_py_for_batch)
+    set(UMAKE_PATH)
+    set(ENTRIES)
+    set(ENTRY_ROOTS)
+    set(ENTRY_ROOT)
+    set(ENTRY_SOURCES)
+    set(MODE)
+    foreach(TOKEN IN LISTS ARGN)
+        if("${TOKEN}" STREQUAL ROOT)
+            if(ENTRY_ROOT)
+                list(APPEND ENTRIES "{\"root\": \"${ENTRY_ROOT}\", \"sources\": [${ENTRY_SOURCES}]}")
+            endif()
+            set(MODE ${TOKEN})
+        elseif("${MODE}" STREQUAL ROOT)
+            get_filename_component(ENTRY_ROOT ${TOKEN} ABSOLUTE BASE_DIR ${CMAKE_CURRENT_LIST_DIR})
+            list(APPEND ENTRY_ROOTS ${ENTRY_ROOT})
+            set(ENTRY_SOURCES)
+            set(MODE SOURCE)
+        elseif("${MODE}" STREQUAL SOURCE)
+            if(ENTRY_SOURCES)
+                string(APPEND ENTRY_SOURCES ", ")
+            endif()
+            string(APPEND ENTRY_SOURCES "\"${TOKEN}\"")
+        elseif(NOT UMAKE_PATH)
+            set(UMAKE_PATH ${TOKEN})
+        else()
+            message(FATAL_ERROR "\"${TOKEN}\" should be after ROOT.")
+        endif()
+    endforeach()
+    if(ENTRY_ROOT)
+        list(APPEND ENTRIES "{\"root\": \"${ENTRY_ROOT}\", \"sources\": [${ENTRY_SOURCES}]}")
+    endif()
+    if(NOT UMAKE_PATH)
+        find_umake_py(UMAKE_PATH)
+    endif()
+
+    list(JOIN ENTRIES ", " MANIFEST)
+    set(MANIFEST_PATH "${CMAKE_CURRENT_BINARY_DIR}/umakeBatch.json")
+    file(WRITE ${MANIFEST_PATH} "[${MANIFEST}]")
+
+    if(EXISTS "${CMAKE_CURRENT_LIST_DIR}/umakeConfig.json")
+        set(CONFIG_FLAGS "--load-config")
+    endif()
+
+    set(COMMAND python ${UMAKE_PATH} ${CONFIG_FLAGS} --root ${CMAKE_CURRENT_LIST_DIR} --target cmake-store --batch ${MANIFEST_PATH})
+    set(STAMP "${CMAKE_CURRENT_BINARY_DIR}/umakeBatch.stamp")
+
+    # Same as execute_umake_py, but every root has its own outputs and depends
+    set(UP_TO_DATE TRUE)
+    set(CONFIGURE_DEPENDS)
+    foreach(ENTRY_ROOT IN LISTS ENTRY_ROOTS)
+        if(NOT EXISTS "${ENTRY_ROOT}/umakeGenerated.txt")
+            set(UP_TO_DATE FALSE)
+        endif()
+        list(APPEND CONFIGURE_DEPENDS "${ENTRY_ROOT}/umakeConfigureDepends.txt")
+    endforeach()
+    if(UP_TO_DATE)
+        # Roots and sources are in the manifest rather than in the command
+        umake_is_up_to_date(UP_TO_DATE ${STAMP} "${COMMAND} ${MANIFEST}" ${CONFIGURE_DEPENDS})
+    endif()
+
+    if(UP_TO_DATE)
+        message(VERBOSE "Scanned files are not changed, skip running umake.")
+        return()
+    endif()
+    execute_process(
+        COMMAND ${COMMAND}
+        OUTPUT_VARIABLE RESULT
+        ERROR_VARIABLE ERROR
+        WORKING_DIRECTORY ${CMAKE_CURRENT_LIST_DIR}
+    )
+    message(VERBOSE ${RESULT})
+    if(ERROR)
+        if(RESULT)
+            message("STDOUT:")
+            message(${RESULT})
+        endif()
+        message("STDERR")
+        message(${ERROR})
+        message(FATAL_ERROR "Error detected during scanning dependencies.")
+    endif()
+    file(WRITE ${STAMP} "${COMMAND} ${MANIFEST}")
+endfunction()
+
+# add_moduled_executables_from_batch()
+function(add_moduled_executables_from_batch)
+    file(READ "${CMAKE_CURRENT_LIST_DIR}/umakeConfigureDepends.txt" DEPENDS)
+    set_property(DIRECTORY APPEND PROPERTY CMAKE_CONFIGURE_DEPENDS ${DEPENDS})
+    file(READ "${CMAKE_CURRENT_LIST_DIR}/umakeGenerated.txt" RESULT)
+    foreach(cmd IN LISTS RESULT)
+        execute_umake_command_for_executable(${cmd})
+    endforeach(cmd)
+endfunction()
+
+# add_moduled_library_from_batch([STATIC|SHARED|MODULE|OBJECT])
+function(add_moduled_library_from_batch)
+    set(TYPE ${ARGN})
+    file(READ "${CMAKE_CURRENT_LIST_DIR}/umakeConfigureDepends.txt" DEPENDS)
+    set_property(DIRECTORY APPEND PROPERTY CMAKE_CONFIGURE_DEPENDS ${DEPENDS})
+    file(READ "${CMAKE_CURRENT_LIST_DIR}/umakeGenerated.txt" RESULT)
+    foreach(cmd IN LISTS RESULT)
+        execute_umake_command_for_library(${cmd} ${TYPE})
+    endforeach(cmd)
+endfunction()
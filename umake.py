@@ -2,131 +2,398 @@
 A minimal build tool for c++ under MIT license.
 Written by TheVeryDarkness, 1853308@tongji.edu.cn on Github.
 """
+
+import hashlib
+import os
 import os.path as path
-from cmake import write_cmake
+from cmake import write_cmake, write_cmake_script
+from collections import deque
+from contextlib import nullcontext, redirect_stdout
+from copy import deepcopy
+from glob import glob
+from io import StringIO
+from typing import Iterable
 from config import *
-from sys import stderr, stdout
+from sys import exit, stderr, stdout
 from scan import *
+from ndjson import (
+    write_ndjson_error,
+    write_ndjson_file,
+    write_ndjson_graph,
+    write_ndjson_header,
+)
+from report import collectHotspots, write_report_dot, write_report_json
+
+# Targets writing results to stdout, with messages written to stderr
+STDOUT_TARGETS = ["ndjson", "report", "report-dot"]
 
 
 def escapeSource(relSrcToRoot: str):
     return relSrcToRoot.replace("/", "__").replace("\\", "__")
 
 
-def main():
-
+def collectAllDependencies(
+    relRoot: str, sources: list[str], ext: extensionMapper
+) -> tuple[
+    dict[str, modulesDependency], dict[str, sourcesDependency], bidict[str, str]
+]:
     modulesToBePreCompiledBySources: dict[str, modulesDependency] = dict()
 
     # relSrcToRoot <--> relExtraSrcToRoot
     extraSourcesBySources: dict[str, sourcesDependency] = dict()
-    extraSourcesToRoot: sourcesDependency = sourcesDependency(set())
     # relSrcToRoot <--> targetName
     objectsDict: bidict[str, str] = bidict()
 
-    if not cacheDisabled:
-        loadCache(relRoot)
-
-    try:
-        ext: extensionMapper = extensionMapper(
-            extHeaders, extSources, extHeaderSourcePairs
+    for source in sources:
+        relSource = path.relpath(source, relRoot)
+        (
+            modulesToBePreCompiledBySources[relSource],
+            extraSourcesBySources[relSource],
+        ) = recursiveCollectDependencies(
+            source, relRoot, verbosity, encoding, ext, logUpdate, set()
         )
-        for relFolderToCur in relFoldersToCur:
-            scanAllFiles(
-                relFolderToCur,
-                relRoot,
-                excludeFiles,
-                excludeDirs,
-                encoding,
-                ext,
-                moduleExtension,
-                verbosity,
-                logUpdate,
-            )
-        cleanCache()
-
-        for source in sources:
-            relSource = path.relpath(source, relRoot)
-            (
-                modulesToBePreCompiledBySources[relSource],
-                extraSourcesBySources[relSource],
-            ) = recursiveCollectDependencies(
-                source, relRoot, verbosity, encoding, ext, logUpdate, set()
-            )
-        for relModuleToRoot in modulesBiDict.values():
-            relModuleToCur = path.relpath(path.join(relRoot, relModuleToRoot))
-            (
-                modulesToBePreCompiledBySources[relModuleToRoot],
-                extraSourcesBySources[relModuleToRoot],
-            ) = recursiveCollectDependencies(
-                relModuleToCur, relRoot, verbosity, encoding, ext, logUpdate, set()
-            )
-        for relModuleToRoot in implDict.values():
-            relModuleToCur = path.relpath(path.join(relRoot, relModuleToRoot))
+    for relModuleToRoot in modulesBiDict.values():
+        relModuleToCur = path.relpath(path.join(relRoot, relModuleToRoot))
+        (
+            modulesToBePreCompiledBySources[relModuleToRoot],
+            extraSourcesBySources[relModuleToRoot],
+        ) = recursiveCollectDependencies(
+            relModuleToCur, relRoot, verbosity, encoding, ext, logUpdate, set()
+        )
+    for relModuleToRoot in implDict.values():
+        relModuleToCur = path.relpath(path.join(relRoot, relModuleToRoot))
+        (
+            modulesToBePreCompiledBySources[relModuleToRoot],
+            extraSourcesBySources[relModuleToRoot],
+        ) = recursiveCollectDependencies(
+            relModuleToCur, relRoot, verbosity, encoding, ext, logUpdate, set()
+        )
+    if autoObj:
+        # Every discovered source is collected once, and its own extra sources are queued
+        worklist: deque[str] = deque()
+        for extraSourcesBySource in extraSourcesBySources.values():
+            worklist.extend(extraSourcesBySource.sources)
+        while worklist:
+            extraSrcToRoot = worklist.popleft()
+            if extraSrcToRoot in objectsDict:
+                continue
+            objectsDict[extraSrcToRoot] = escapeSource(extraSrcToRoot)
+            if extraSrcToRoot in extraSourcesBySources:
+                continue
+            extraSrcToCur = path.relpath(path.join(relRoot, extraSrcToRoot))
             (
-                modulesToBePreCompiledBySources[relModuleToRoot],
-                extraSourcesBySources[relModuleToRoot],
+                modulesToBePreCompiledBySources[extraSrcToRoot],
+                extraSourcesBySources[extraSrcToRoot],
             ) = recursiveCollectDependencies(
-                relModuleToCur, relRoot, verbosity, encoding, ext, logUpdate, set()
+                extraSrcToCur, relRoot, verbosity, encoding, ext, logUpdate, set()
             )
-        if autoObj:
-            for extraSourcesBySource in extraSourcesBySources.values():
-                extraSourcesToRoot.unionWith(extraSourcesBySource)
-            for extraSrcToRoot in extraSourcesToRoot.sources:
-                extraSrcToCur = path.relpath(path.join(relRoot, extraSrcToRoot))
-                (
-                    modulesToBePreCompiledBySources[extraSrcToRoot],
-                    extraSourcesBySources[extraSrcToRoot],
-                ) = recursiveCollectDependencies(
-                    extraSrcToCur, relRoot, verbosity, encoding, ext, logUpdate, set()
+            worklist.extend(extraSourcesBySources[extraSrcToRoot].sources)
+
+    modules_not_found: list[str] = []
+    for _source, modulesToBePreCompiled in modulesToBePreCompiledBySources.items():
+        for moduleToBePreCompiled in modulesToBePreCompiled.module:
+            if moduleToBePreCompiled not in modulesBiDict:
+                print(
+                    YELLOW
+                    + 'Imported module "{}" from dependencies of {} is not found'.format(
+                        moduleToBePreCompiled, _source
+                    )
+                    + RESET
                 )
-                objectsDict[extraSrcToRoot] = escapeSource(extraSrcToRoot)
-            updated_one_source = True
-            while updated_one_source:
-                updated_one_source = False
-                for source, extraSourcesToRoot in extraSourcesBySources.copy().items():
-                    for extraSrcToRoot in extraSourcesToRoot.sources:
-                        extraSrcToCur = path.relpath(path.join(relRoot, extraSrcToRoot))
-                        if extraSrcToRoot not in extraSourcesBySources.keys():
-                            (
-                                modulesToBePreCompiledBySources[extraSrcToRoot],
-                                extraSourcesBySources[extraSrcToRoot],
-                            ) = recursiveCollectDependencies(
-                                extraSrcToCur,
-                                relRoot,
-                                verbosity,
-                                encoding,
-                                ext,
-                                logUpdate,
-                                set(),
-                            )
-                            objectsDict[extraSrcToRoot] = escapeSource(extraSrcToRoot)
-                            updated_one_source = True
-
-        modules_not_found: list[str] = []
-        for _source, modulesToBePreCompiled in modulesToBePreCompiledBySources.items():
-            for moduleToBePreCompiled in modulesToBePreCompiled.module:
-                if moduleToBePreCompiled not in modulesBiDict:
+                modules_not_found.append(modulesToBePreCompiled)
+
+    if len(modules_not_found) != 0:
+        for _source, _deps in depsDict.items():
+            for imported in _deps.modules.module:
+                if imported not in modulesBiDict:
                     print(
                         YELLOW
-                        + 'Imported module "{}" from dependencies of {} is not found'.format(
-                            moduleToBePreCompiled, _source
+                        + 'Module "{}" imported from "{}" is not found.'.format(
+                            imported, _source
                         )
                         + RESET
                     )
-                    modules_not_found.append(modulesToBePreCompiled)
-
-        if len(modules_not_found) != 0:
-            for _source, _deps in depsDict.items():
-                for imported in _deps.modules.module:
-                    if imported not in modulesBiDict:
-                        print(
-                            YELLOW
-                            + 'Module "{}" imported from "{}" is not found.'.format(
-                                imported, _source
-                            )
-                            + RESET
-                        )
 
+    return modulesToBePreCompiledBySources, extraSourcesBySources, objectsDict
+
+
+def writeIfChanged(relOutToCur: str, text: str) -> bool:
+    """
+    Keep the file untouched if its content is not changed,
+    so that nothing depending on it would be regenerated.
+    """
+    data = text.replace("\n", os.linesep).encode("utf-8")
+    if path.exists(relOutToCur):
+        with open(relOutToCur, "rb") as old:
+            if hashlib.sha256(old.read()).digest() == hashlib.sha256(data).digest():
+                if verbosity >= VERBOSITY_UNMODIFIED_FILE:
+                    print(BLUE + f'"{relOutToCur}" is not changed, skipped' + RESET)
+                return False
+    if verbosity >= VERBOSITY_MODIFIED_FILE:
+        print(BLUE + f'Writing "{relOutToCur}"' + RESET)
+    with openAtomically(relOutToCur, "wb") as out:
+        out.write(data)
+    return True
+
+
+def writeConfigureDepends(
+    relRootToCur: str, relFilesToRoot: Iterable[str], relFoldersToCur: Iterable[str]
+):
+    """
+    Write files and directories umake depends on as a CMake list,
+    so that CMake knows when umake should be run again.
+    Walked directories are included, as adding or removing files in them changes them,
+    except those in build trees, which change on every build.
+    """
+    depends: set[str] = set()
+    for relFileToRoot in relFilesToRoot:
+        depends.add(path.abspath(path.join(relRootToCur, relFileToRoot)))
+
+    relFoldersToCur = list(relFoldersToCur)
+    relBuildTreesToCur: list[str] = []
+    for relDirToCur in sorted(extNamesByStems):
+        if not any(isUnder(relDirToCur, folder) for folder in relFoldersToCur):
+            continue
+        if any(isUnder(relDirToCur, buildTree) for buildTree in relBuildTreesToCur):
+            continue
+        if path.exists(path.join(relDirToCur, "CMakeCache.txt")):
+            relBuildTreesToCur.append(relDirToCur)
+            continue
+        depends.add(path.abspath(relDirToCur))
+    depends.add(path.abspath(relRootToCur))
+    depends.update(path.abspath(folder) for folder in relFoldersToCur)
+
+    # Outputs might change with umake itself or its configuration
+    depends.update(glob(path.join(path.dirname(path.abspath(__file__)), "*.py")))
+    # Loaded from the root umake is run on, even for roots in a batch
+    if path.exists(path.join(relRoot, CONFIG_PATH)):
+        depends.add(path.abspath(path.join(relRoot, CONFIG_PATH)))
+
+    writeIfChanged(
+        path.join(relRootToCur, CONFIGURE_DEPENDS_PATH),
+        ";".join(sorted(depends)).replace("\\", "/"),
+    )
+
+
+def runBatch(ext: extensionMapper, objects: dict[str, str], targets: dict[str, str]):
+    """
+    Write outputs under every root in the batch manifest, as if umake were run on
+    each of them, while files are only scanned once.
+    Names of objects and targets are collected into given dictionaries prefixed with
+    their roots, and their sources are relative to root.
+    """
+    scannedDict: dict[str, dependency] = dict(depsDict)
+    try:
+        for entry in batchEntries:
+            relEntryRootToCur = path.relpath(path.join(relRoot, entry["root"]))
+            relEntryRootToRoot = path.relpath(relEntryRootToCur, relRoot)
+
+            def toRoot(relFileToEntryRoot: str) -> str:
+                return path.relpath(path.join(relEntryRootToRoot, relFileToEntryRoot))
+
+            relEntryFoldersToRoot = [
+                path.relpath(path.join(relEntryRootToCur, folder), relRoot)
+                for folder in entry.get("folders", [path.curdir])
+            ]
+            entrySources: list[str] = entry.get("sources", [])
+            assert (
+                len(entrySources) % 2 == 0
+            ), "Target should match source in {}".format(entry["root"])
+            relEntrySourcesToCur = [
+                path.relpath(path.join(relEntryRootToCur, entrySources[2 * i + 1]))
+                for i in range(len(entrySources) // 2)
+            ]
+
+            # Only files in folders of this root are visible, with paths relative to it
+            depsDict.clear()
+            modulesBiDict.clear()
+            implDict.clear()
+            calculatedDependencies.clear()
+            for relFileToRoot, dep in scannedDict.items():
+                if not any(
+                    isUnder(relFileToRoot, relFolderToRoot)
+                    for relFolderToRoot in relEntryFoldersToRoot
+                ):
+                    continue
+                relFileToEntryRoot = path.relpath(relFileToRoot, relEntryRootToRoot)
+                dep = deepcopy(dep)
+                dep.sources.sources = {
+                    path.relpath(relSrcToRoot, relEntryRootToRoot)
+                    for relSrcToRoot in dep.sources.sources
+                }
+                depsDict[relFileToEntryRoot] = dep
+                if dep.implement:
+                    implDict.setdefault(dep.implement, relFileToEntryRoot)
+                if dep.provide:
+                    modulesBiDict.update({dep.provide: relFileToEntryRoot})
+            targetsBidict.clear()
+            targetsBidict.update(
+                (entrySources[2 * i], path.relpath(relSourceToCur, relEntryRootToCur))
+                for i, relSourceToCur in enumerate(relEntrySourcesToCur)
+            )
+            relSourcesToRoot[:] = targetsBidict.values()
+
+            dirtyBefore = set(dirtyFiles)
+            try:
+                (
+                    modulesToBePreCompiledBySources,
+                    extraSourcesBySources,
+                    objectsDict,
+                ) = collectAllDependencies(relEntryRootToCur, relEntrySourcesToCur, ext)
+                out = StringIO()
+                (write_cmake_script if target == "cmake-script" else write_cmake)(
+                    out=out,
+                    modulesToBePreCompiledBySources=modulesToBePreCompiledBySources,
+                    objectsDict=objectsDict,
+                    extraSourcesBySources=extraSourcesBySources,
+                )
+                writeIfChanged(
+                    path.join(relEntryRootToCur, relOutToRoot), out.getvalue()
+                )
+                writeConfigureDepends(
+                    relEntryRootToCur,
+                    depsDict.keys(),
+                    (
+                        path.join(relRoot, relFolderToRoot)
+                        for relFolderToRoot in relEntryFoldersToRoot
+                    ),
+                )
+                for relSourceToEntryRoot, object in objectsDict.items():
+                    objects[toRoot(object)] = toRoot(relSourceToEntryRoot)
+                for name, relSourceToEntryRoot in targetsBidict.items():
+                    targets[toRoot(name)] = toRoot(relSourceToEntryRoot)
+            except:
+                # Blame files by paths relative to root
+                for relFileToEntryRoot in dirtyFiles - dirtyBefore:
+                    dirtyFiles.remove(relFileToEntryRoot)
+                    dirtyFiles.add(toRoot(relFileToEntryRoot))
+                for relRemovedToEntryRoot, relDependentToEntryRoot in list(
+                    removedDependencies.items()
+                ):
+                    del removedDependencies[relRemovedToEntryRoot]
+                    removedDependencies[toRoot(relRemovedToEntryRoot)] = (
+                        relDependentToEntryRoot and toRoot(relDependentToEntryRoot)
+                    )
+                raise
+    finally:
+        depsDict.clear()
+        depsDict.update(scannedDict)
+
+
+def printAffected():
+    index = loadReverseIndex(relRoot)
+    affected, relinked = collectAffected(
+        index, {path.relpath(changed, relRoot) for changed in affectedBy}
+    )
+    modules: dict[str, str] = index["modules"]
+    objects: dict[str, str] = index["objects"]
+    targets: dict[str, str] = index["targets"]
+    for module, relModuleToRoot in sorted(modules.items()):
+        if relModuleToRoot in affected:
+            print(f"MODULE {module} SOURCE {relModuleToRoot}")
+    for object, relObjectToRoot in sorted(objects.items()):
+        if relObjectToRoot in affected:
+            print(f"OBJECT {object} SOURCE {relObjectToRoot}")
+        elif relObjectToRoot in relinked:
+            print(f"OBJECT {object} SOURCE {relObjectToRoot} RELINK")
+    for target, relTargetToRoot in sorted(targets.items()):
+        if relTargetToRoot in affected:
+            print(f"TARGET {target} SOURCE {relTargetToRoot}")
+        elif relTargetToRoot in relinked:
+            print(f"TARGET {target} SOURCE {relTargetToRoot} RELINK")
+
+
+def manageCache():
+    if cacheAction == "stats":
+        printCacheStats(relRoot)
+    elif cacheAction == "gc":
+        collectCacheGarbage(relRoot, verbosity)
+    elif cacheAction == "verify":
+        ext = extensionMapper(extHeaders, extSources, extHeaderSourcePairs)
+        if not verifyCache(relRoot, encoding, ext, verbosity):
+            exit(1)
+
+
+def main():
+    if affectedBy:
+        printAffected()
+        return
+    if cacheAction:
+        # Not logged, so that the last run is still the last scanning
+        manageCache()
+        return
+
+    # Fragments are merged instead of cache
+    if not cacheDisabled and not merging:
+        loadCache(relRoot)
+        if sharedCacheDir:
+            loadSharedCache(sharedCacheDir)
+
+    if target == "ndjson":
+        write_ndjson_header(stdout, relRoot)
+        fileListeners.append(
+            lambda relFileToRoot, info, origin: write_ndjson_file(
+                stdout, relFileToRoot, info, origin
+            )
+        )
+
+    # Names of objects and targets --> sources, of all roots in batch
+    batchObjects: dict[str, str] = dict()
+    batchTargets: dict[str, str] = dict()
+    try:
+        ext: extensionMapper = extensionMapper(
+            extHeaders, extSources, extHeaderSourcePairs
+        )
+        if merging:
+            mergeCacheFragments(relRoot, relFragmentsToCur, verbosity)
+        else:
+            for relFolderToCur in relFoldersToCur:
+                scanAllFiles(
+                    relFolderToCur,
+                    relRoot,
+                    excludeFiles,
+                    excludeDirs,
+                    encoding,
+                    ext,
+                    moduleExtension,
+                    verbosity,
+                    logUpdate,
+                    prefetchDepth,
+                    prefetchWorkers,
+                    shard,
+                )
+        cleanCache(relRoot, verbosity, shard)
+
+        if shard:
+            # Dependencies can't be collected until all shards are merged
+            saveCacheFragment(relRoot, shard, verbosity)
+            if not cacheDisabled and sharedCacheDir:
+                saveSharedCache(sharedCacheDir)
+            return
+
+        if batchManifest:
+            runBatch(ext, batchObjects, batchTargets)
+            if not cacheDisabled:
+                saveCache(relRoot)
+                saveReverseIndex(relRoot, batchObjects, batchTargets)
+                if sharedCacheDir:
+                    saveSharedCache(sharedCacheDir)
+            return
+
+        (
+            modulesToBePreCompiledBySources,
+            extraSourcesBySources,
+            objectsDict,
+        ) = collectAllDependencies(relRoot, sources, ext)
+        # Saved before writing outputs, so that valid results are kept even if writing fails
+        if not cacheDisabled:
+            saveCache(relRoot)
+            saveReverseIndex(relRoot, objectsDict.inverse, targetsBidict)
+            if sharedCacheDir:
+                saveSharedCache(sharedCacheDir)
+
+        if target and target.startswith("cmake"):
+            writeConfigureDepends(relRoot, depsDict.keys(), relFoldersToCur)
         if target == "info-only":
             print(GREEN + str(modulesToBePreCompiledBySources) + RESET)
             print(BLUE + str(modulesBiDict) + RESET)
@@ -140,27 +407,75 @@ def main():
                 extraSourcesBySources=extraSourcesBySources,
             )
         elif target == "cmake-store":
-            with open(relOutToCur, "w", encoding="utf-8") as out:
-                write_cmake(
-                    out=out,
-                    modulesToBePreCompiledBySources=modulesToBePreCompiledBySources,
-                    objectsDict=objectsDict,
-                    extraSourcesBySources=extraSourcesBySources,
-                )
+            out = StringIO()
+            write_cmake(
+                out=out,
+                modulesToBePreCompiledBySources=modulesToBePreCompiledBySources,
+                objectsDict=objectsDict,
+                extraSourcesBySources=extraSourcesBySources,
+            )
+            writeIfChanged(relOutToCur, out.getvalue())
+        elif target == "cmake-script":
+            out = StringIO()
+            write_cmake_script(
+                out=out,
+                modulesToBePreCompiledBySources=modulesToBePreCompiledBySources,
+                objectsDict=objectsDict,
+                extraSourcesBySources=extraSourcesBySources,
+            )
+            writeIfChanged(relOutToCur, out.getvalue())
+        elif target == "ndjson":
+            write_ndjson_graph(
+                out=stdout,
+                modulesToBePreCompiledBySources=modulesToBePreCompiledBySources,
+                objectsDict=objectsDict,
+                extraSourcesBySources=extraSourcesBySources,
+            )
+        elif target == "report":
+            write_report_json(stdout, collectHotspots(relRoot, ext), reportTop)
+        elif target == "report-dot":
+            write_report_dot(stdout, collectHotspots(relRoot, ext), reportTop)
         else:
             print(depsDict)
-        if not cacheDisabled:
-            saveCache(relRoot)
+    except BrokenPipeError:
+        # Reader of stdout is gone, such as in "umake.py --target report | head",
+        # which is not a failure of scanning and results are already saved
+        discardOutput(stdout)
     except Exception as e:
+        if target == "ndjson":
+            write_ndjson_error(stdout, str(e))
         print("\t", RED + str(e) + RESET, sep="", file=stderr)
         print(
             RED + "Failed for parsed arguments: {}.".format(args) + RESET, file=stderr
         )
-        if not cacheDisabled:
-            deleteCache(relRoot)
+        # Entries are only dropped if blamed, and fragments failing to merge don't replace cache
+        if not cacheDisabled and not merging:
+            deps = savePartialCache(relRoot)
+            # Only roots in batch completed before the failure are kept
+            if batchManifest:
+                saveReverseIndex(relRoot, batchObjects, batchTargets, deps)
+            else:
+                saveReverseIndex(
+                    relRoot,
+                    (
+                        {
+                            escapeSource(relSourceToRoot): relSourceToRoot
+                            for dep in deps.values()
+                            for relSourceToRoot in dep.sources.sources
+                        }
+                        if autoObj
+                        else dict()
+                    ),
+                    targetsBidict,
+                    deps,
+                )
+            if sharedCacheDir:
+                saveSharedCache(sharedCacheDir)
         if verbosity >= VERBOSITY_SHOW_STACKTRACE:
             print(YELLOW + "Re-raise for stack trace." + RESET)
             raise
+    finally:
+        flushLog(relRoot, logMaxSize, logBackups)
 
 
 if __name__ == "__main__":
@@ -168,7 +483,9 @@ if __name__ == "__main__":
     # profile.run("main()")
     # import cProfile
     # cProfile.run("main()")
-    main()
+    # Messages are written to stderr, so that stdout only contains records
+    with redirect_stdout(stderr) if target in STDOUT_TARGETS else nullcontext():
+        main()
 
     # import tracemalloc
     # tracemalloc.start()